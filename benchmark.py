@@ -0,0 +1,273 @@
+#!/bin/env python3
+#
+# End-to-end latency benchmark of the Nobbler pipeline.
+#
+# Runs the knob, action and state tasks against a simulated knob,
+# turns it one detent at a time and timestamps every step
+# from the knob's serial frame to the spawned action command:
+#
+#   simulated knob sends state
+#     -> Smartknob._process_frame
+#     -> task.knob.message_from_knob
+#     -> Q_KNOB -> task.knob.handle_data
+#     -> command.do_action
+#     -> Q_ACTION -> task.action._perform_action
+#     -> subprocess.Popen
+#
+# Latency (p50/p99/max) and throughput of each stage is written as JSON.
+# Each detent is traced by its knob position, so stages which deliberately
+# skip intermediate values only report on the values that got through.
+#
+
+import argparse
+import contextlib
+import json
+import sys
+import threading
+import time
+
+import command
+import config
+import task.action
+import task.knob
+import task.state
+
+from smartknob_io.smartknob_io import Smartknob
+
+
+# Stage name, timestamp at start of stage, timestamp at end of stage
+STAGES = [
+  ( "serial",      "emit",          "process_frame" ),
+  ( "decode",      "process_frame", "message_from_knob" ),
+  ( "q_knob",      "message_from_knob", "handle_data" ),
+  ( "handle_data", "handle_data",   "do_action" ),
+  ( "q_action",    "do_action",     "perform_action" ),
+  ( "perform",     "perform_action", "popen" ),
+  ( "popen",       "popen",         "popen_done" ),
+  ( "end_to_end",  "emit",          "popen_done" ),
+]
+
+# position -> { timestamp name -> time }
+TRACES = {}
+TRACES_LOCK = threading.Lock()
+
+_CURRENT = threading.local()
+
+
+def _record(position, name, t=None):
+  if t is None:
+    t = time.perf_counter()
+
+  with TRACES_LOCK:
+    trace = TRACES.setdefault(position, {})
+
+    # The knob keeps reporting the same position,
+    # only the first sighting counts.
+    if name not in trace:
+      trace[name] = t
+
+
+def _instrument():
+  process_frame = Smartknob._process_frame
+  def _process_frame(self, frame):
+    _CURRENT.frame_start = time.perf_counter()
+    return process_frame(self, frame)
+  Smartknob._process_frame = _process_frame
+
+  message_from_knob = task.knob.message_from_knob
+  def _message_from_knob(queue, knob_id, message_type, message):
+    if message_type == "smartknob_state":
+      _record(message.current_position, "process_frame", getattr(_CURRENT, "frame_start", None))
+      _record(message.current_position, "message_from_knob")
+    return message_from_knob(queue, knob_id, message_type, message)
+  task.knob.message_from_knob = _message_from_knob
+
+  handle_data = task.knob.handle_data
+  def _handle_data(knob_id, msg):
+    _record(msg.current_position, "handle_data")
+    return handle_data(knob_id, msg)
+  task.knob.handle_data = _handle_data
+
+  do_action = command.do_action
+  def _do_action(knob_id, action_name, delta, current_value, min_value, max_value, **kwargs):
+    _record(current_value, "do_action")
+    return do_action(knob_id, action_name, delta, current_value, min_value, max_value, **kwargs)
+  command.do_action = _do_action
+
+  perform_action = task.action._perform_action
+  def _perform_action(source_knob_id, action_config, received_cmd):
+    _CURRENT.position = received_cmd["value"]
+    _record(received_cmd["value"], "perform_action")
+    try:
+      return perform_action(source_knob_id, action_config, received_cmd)
+    finally:
+      _CURRENT.position = None
+  task.action._perform_action = _perform_action
+
+  # Only Popen calls made by an action are of interest
+  popen = task.action.subprocess.Popen
+  def _popen(*args, **kwargs):
+    position = getattr(_CURRENT, "position", None)
+    if position is not None:
+      _record(position, "popen")
+    proc = popen(*args, **kwargs)
+    if position is not None:
+      _record(position, "popen_done")
+    return proc
+  task.action.subprocess.Popen = _popen
+
+
+def _percentile(values, p):
+  index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+  return values[index]
+
+
+def _report(conf):
+  stages = {}
+
+  for name, start, end in STAGES:
+    latencies = []
+    ends = []
+    for trace in TRACES.values():
+      if start in trace and end in trace:
+        latencies.append(trace[end] - trace[start])
+        ends.append(trace[end])
+
+    if not latencies:
+      stages[name] = { "count": 0 }
+      continue
+
+    latencies.sort()
+    duration = max(ends) - min(ends)
+    stages[name] = {
+      "count": len(latencies),
+      "p50_ms": _percentile(latencies, 50) * 1000,
+      "p99_ms": _percentile(latencies, 99) * 1000,
+      "max_ms": latencies[-1] * 1000,
+      "throughput_per_s": (len(latencies) - 1) / duration if duration > 0 else None,
+    }
+
+  return {
+    "steps": conf.steps,
+    "interval_s": conf.interval,
+    "state_rate": conf.state_rate,
+    "command": conf.command,
+    "stages": stages,
+  }
+
+
+def _bench_config(conf):
+  return {
+    "nobbler": { "verbose": False },
+
+    "knobs": {
+      "interfaces": [
+        { "kind": "simulated", "state_rate": conf.state_rate }
+      ]
+    },
+
+    "actions": [
+      { "name": "bench",
+        "steps": [
+          { "kind": "command", "command": conf.command }
+        ]
+      }
+    ],
+
+    "views": [
+      {
+        "name": "bench",
+        "knob_action": "bench",
+        "config": {
+          "position": 0,
+          "min_position": 0,
+          "max_position": conf.steps + 1,
+          "position_width_radians": 0.1,
+          "detent_strength_unit": 1,
+          "snap_point": 1.1,
+          "text": "Benchmark",
+          "detent_positions": [],
+          "snap_point_bias": 0,
+          "led_hue": 0
+        }
+      }
+    ],
+
+    "triggers": []
+  }
+
+
+def _stop(threads):
+  command.stop_state()
+  command.stop_action()
+  command.stop_knob()
+  for t in threads:
+    t.join()
+
+
+def _run(conf):
+  app_config = config.validate_config(_bench_config(conf))
+
+  _instrument()
+  command.init()
+
+  threads = [
+    threading.Thread(target=task.state.main, args=(app_config,)),
+    threading.Thread(target=task.action.main, args=(app_config,)),
+    threading.Thread(target=task.knob.main, args=(app_config,)),
+  ]
+  for t in threads:
+    t.start()
+
+  # Wait for the knob to be connected and showing the benchmark view
+  deadline = time.time() + 10
+  while time.time() < deadline:
+    if task.knob.SIMULATED_KNOBS and task.knob.SIMULATED_KNOBS[0].config.text == "Benchmark":
+      break
+    time.sleep(0.01)
+  else:
+    print("Simulated knob never came up.", file=sys.stderr)
+
+    # Without a knob there's nothing to measure
+    if not task.knob.SIMULATED_KNOBS:
+      _stop(threads)
+      sys.exit("No simulated knob was connected. Nothing to benchmark.")
+
+  simulator = task.knob.SIMULATED_KNOBS[0]
+
+  for step in range(conf.steps):
+    _record(simulator.current_position + 1, "emit")
+    simulator.rotate(1)
+    time.sleep(conf.interval)
+
+  # Let the pipeline drain
+  time.sleep(conf.drain)
+
+  _stop(threads)
+
+
+def main():
+  parser = argparse.ArgumentParser("Measure knob-to-command latency of the Nobbler pipeline")
+  parser.add_argument("--steps", type=int, default=200, help="Number of detents to turn the knob")
+  parser.add_argument("--interval", type=float, default=0.01, help="Seconds between detents")
+  parser.add_argument("--state-rate", type=float, default=1000, help="State messages per second from the simulated knob")
+  parser.add_argument("--command", default="exit 0", help="Action command to run for each detent")
+  parser.add_argument("--drain", type=float, default=1.0, help="Seconds to wait for the pipeline to finish")
+  parser.add_argument("--output", default=None, help="Write the JSON report here instead of stdout")
+  conf = parser.parse_args()
+
+  # The tasks print as they go. Keep that out of the report.
+  with contextlib.redirect_stdout(sys.stderr):
+    _run(conf)
+
+  report = json.dumps(_report(conf), indent=2)
+
+  if conf.output:
+    with open(conf.output, "w") as f:
+      f.write(report + "\n")
+  else:
+    print(report)
+
+
+if __name__ == "__main__":
+  main()
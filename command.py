@@ -1,6 +1,5 @@
 import queue
 import os
-import multiprocessing
 
 import task.action
 import task.state
@@ -32,11 +31,8 @@ def init():
   global Q_TRIGGER
   Q_TRIGGER = queue.Queue()
 
-  # This needs to be a multiprocessing queue
-  # because we use multiprocessing for the
-  # background commands.
   global Q_STATE
-  Q_STATE = multiprocessing.Queue()
+  Q_STATE = queue.Queue()
 
 #
 # Send a command to change a knob's
@@ -51,9 +47,11 @@ def set_view(view_name, knob=None):
 #
 # Perform a configured action
 # Knob data is included, because
-# the action may have to do scaling
+# the action may have to do scaling.
+# If coalesce is set, the value may be replaced by
+# a newer one before the action gets around to it.
 #
-def do_action(knob_id, action_name, delta, current_value, min_value, max_value):
+def do_action(knob_id, action_name, delta, current_value, min_value, max_value, coalesce=False):
   cmd = {
           "cmd": "do_action",
           "knob_id": knob_id,
@@ -61,7 +59,8 @@ def do_action(knob_id, action_name, delta, current_value, min_value, max_value):
           "delta": delta,
           "value": current_value,
           "min": min_value,
-          "max": max_value
+          "max": max_value,
+          "coalesce": coalesce
         }
   Q_ACTION.put(cmd)
 
@@ -78,11 +77,65 @@ def action_get_value(action_name, v_min, v_max, allow_delay=False):
  
   value = task.state.get_value_for_action(action_name, v_min, v_max, allow_delay)
 
-  if not value:
+  if value is None:
     return None
   
   return round(value)
 
+#
+# Tell the state task which action a knob's new view
+# uses for turning, so it can start running that action's
+# get_command if it only runs while in use.
+#
+def view_shown(knob_id, action_name):
+  cmd = {
+          "cmd": "view-shown",
+          "knob_id": knob_id,
+          "action": action_name
+        }
+  Q_STATE.put(cmd)
+
+#
+# Run callback() as soon as the action's get_command
+# has produced its first value, from whichever thread
+# delivers it. If there already is a value, it's run right away.
+# Returns False if the action will never have a value.
+#
+def when_action_value_available(action_name, callback):
+  return task.state.when_value_available(action_name, callback)
+
+#
+# Tell the knob task that there's a value from an action's
+# get_command, which should be shown on the knob
+#
+def action_value_available(knob_id, action_name):
+  cmd = {
+          "cmd": "action-value",
+          "knob_id": knob_id,
+          "action": action_name
+        }
+  Q_KNOB.put(cmd)
+
+#
+# Run callback(action_name) whenever the value from
+# an action's get_command changes, after its first value
+#
+def subscribe_action_values(callback):
+  task.state.subscribe_value_changes(callback)
+
+#
+# Tell the knob task that the value from an action's get_command
+# has changed. Every knob showing a view with that knob_action
+# will be moved to the new value.
+#
+def action_value_changed(action_name):
+  cmd = {
+          "cmd": "action-value",
+          "knob_id": None,
+          "action": action_name
+        }
+  Q_KNOB.put(cmd)
+
 def window_focused(title, appname):
   cmd = {
           "cmd": "window-focused",
@@ -96,6 +149,32 @@ def window_focused(title, appname):
 
 
 
+#
+# A serial port has appeared, maybe with a knob on it.
+# port is from serial.tools.list_ports
+#
+def serial_port_added(port):
+  cmd = { "cmd": "port-added", "port": port }
+  Q_KNOB.put(cmd)
+
+#
+# A serial port has disappeared, along with any knob on it
+#
+def serial_port_removed(portname):
+  cmd = { "cmd": "port-removed", "portname": portname }
+  Q_KNOB.put(cmd)
+
+#
+# Hand a reloaded configuration to every task.
+# Each of them works out what has changed.
+#
+def reload_config(app_config):
+  cmd = { "cmd": "config", "config": app_config }
+
+  for q in [ Q_STATE, Q_ACTION, Q_TRIGGER, Q_KNOB ]:
+    q.put(cmd)
+
+
 def stop_knob():
   Q_KNOB.put(None)
 
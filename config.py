@@ -1,8 +1,15 @@
+import hashlib
+import marshal
+import math
+import os
 import re
 
 import json5
 from schema import Schema, And, Or, Use, Regex, Optional
 
+from smartknob_io.smartknob_io import patch_config_position
+from smartknob_io.proto_gen import smartknob_pb2
+
 def is_valid_regex(pattern):
     try:
         re.compile(pattern)
@@ -14,12 +21,30 @@ def is_valid_regex(pattern):
 CONFIG_SCHEMA = Schema(
   {
     "nobbler": {
-      "verbose": bool
+      Optional("verbose", default=False): bool
     },
 
     "knobs": {
         "interfaces": [
-          { "kind": And(str, lambda v: v in [ "serial" ])}
+          Or(
+              {
+                "kind": "serial",
+                Optional("name"): str,
+                Optional("id"): str,
+                Optional("device"): str,
+                Optional("sub_position_threshold"): Use(float)
+              },
+              {
+                # A knob simulated in software, for testing without hardware
+                "kind": "simulated",
+                Optional("name"): str,
+                Optional("state_rate", default=50): Use(float),
+                Optional("jitter", default=0.02): Use(float),
+                Optional("drop_rate", default=0.0): Use(float),
+                Optional("corrupt_rate", default=0.0): Use(float),
+                Optional("sub_position_threshold"): Use(float)
+              }
+          )
         ]
 
     },
@@ -32,6 +57,13 @@ CONFIG_SCHEMA = Schema(
           Optional("scaling"): And([int], lambda l: len(l)==2),
           Optional("round", default=True): bool,
           Optional("get_command"): str,
+          Optional("get_max_rate"): And(Use(float), lambda r: r > 0),
+          Optional("get_interval", default=1.0): And(Use(float), lambda v: v >= 0),
+          Optional("get_jitter", default=0.1): And(Use(float), lambda v: 0 <= v <= 1),
+          Optional("get_backoff_max", default=60.0): And(Use(float), lambda v: v >= 0),
+          Optional("get_when", default="always"): And(str, lambda s: s in [ "always", "active" ]),
+          Optional("max_rate"): And(Use(float), lambda r: r > 0),
+          Optional("command_timeout"): And(Use(float), lambda t: t > 0),
 
           "steps": [
             Or(
@@ -43,6 +75,12 @@ CONFIG_SCHEMA = Schema(
                     "kind": "command",
                     "command": str
                 },
+                {
+                    # Started once, then fed one line of input per invocation
+                    "kind": "persistent-command",
+                    "command": str,
+                    Optional("input"): str
+                },
                 {
                     "kind": "view",
                     Optional("knob"): str,
@@ -77,6 +115,9 @@ CONFIG_SCHEMA = Schema(
       Or(
         {
           "kind": "active-window",
+          Optional("backend", default="auto"): And(str, lambda s: s in [ "auto", "x11", "poll" ]),
+          Optional("poll_interval", default=0.2): And(Use(float), lambda v: v > 0),
+          Optional("settle_time", default=0.1): And(Use(float), lambda v: v >= 0),
           "mappings": [
             {
               "filters": [
@@ -227,5 +268,202 @@ def default_config():
 
   }
 
+#
+# A view's knob configuration, built and serialized once.
+# Showing the view only needs position and position_nonce
+# patched onto the cached bytes.
+#
+class ViewTemplate(object):
+  def __init__(self, knob_config):
+    config = smartknob_pb2.SmartKnobConfig()
+    config.min_position = knob_config.get("min_position", 0)
+    config.max_position = knob_config.get("max_position", 5)
+    config.position_width_radians = knob_config.get("position_width_radians", math.radians(10))
+    config.detent_strength_unit = knob_config.get("detent_strength_unit", 1)
+    config.endstop_strength_unit = knob_config.get("endstop_strength_unit", 1)
+    config.snap_point = knob_config.get("snap_point", 1.1)
+    config.text = knob_config.get("text", "NO TEXT CONFIGURED!!")
+    config.led_hue = knob_config.get("led_hue", 0)
+
+    # Without position and position_nonce
+    self.config = config
+    self.config_bytes = config.SerializeToString(deterministic=True)
+
+  def config_with_position(self, position, position_nonce):
+    return patch_config_position(self.config_bytes, position, position_nonce)
+
+  # Views from a reloaded configuration compare equal
+  # if the knob would get the same config
+  def __eq__(self, other):
+    return isinstance(other, ViewTemplate) and self.config_bytes == other.config_bytes
+
+#
+# Give each view a ViewTemplate, as view["template"]
+#
+def compile_views(app_config):
+  for view in app_config["views"]:
+    view["template"] = ViewTemplate(view["config"])
+
+  return app_config
+
 def validate_config(app_config):
-  return CONFIG_SCHEMA.validate(app_config)
\ No newline at end of file
+  return compile_views(CONFIG_SCHEMA.validate(app_config))
+
+
+#
+# Loading the configuration from config/*.json5
+#
+
+# Each section of the configuration lives in its own file.
+# Sections which aren't required get this if the file is missing.
+CONFIG_FILES = {
+  "nobbler":  { "file": "nobbler.json5",  "default": {} },
+  "knobs":    { "file": "knobs.json5",    "required": True },
+  "actions":  { "file": "actions.json5",  "required": True },
+  "views":    { "file": "views.json5",    "required": True },
+  "triggers": { "file": "triggers.json5", "default": [] },
+}
+
+CONFIG_CACHE_FILE = ".nobbler-cache"
+
+# Bump this when the format of the cached configuration changes
+CONFIG_CACHE_VERSION = 2
+
+class ConfigError(Exception):
+  pass
+
+def _stat_key(paths):
+  key = []
+  for path in paths:
+    try:
+      st = os.stat(path)
+      key.append((path, st.st_mtime_ns, st.st_size))
+    except FileNotFoundError:
+      key.append((path, None, None))
+
+  # A change to the schema has to invalidate the cache, too
+  st = os.stat(__file__)
+  key.append((__file__, st.st_mtime_ns, st.st_size))
+
+  return tuple(key)
+
+def _read_cache(cache_path):
+  try:
+    with open(cache_path, "rb") as f:
+      cache = marshal.load(f)
+  except (OSError, EOFError, ValueError, TypeError):
+    return None
+
+  if not isinstance(cache, dict) or cache.get("version", None) != CONFIG_CACHE_VERSION:
+    return None
+
+  return cache
+
+def _write_cache(cache_path, cache):
+  # Write and rename, so a half-written cache is never read
+  tmp_path = cache_path + ".tmp"
+  try:
+    with open(tmp_path, "wb") as f:
+      marshal.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+  except OSError:
+    # Nothing to worry about, it'll just be slow next time
+    pass
+
+#
+# Read, parse and validate the config files in config_dir.
+#
+# The validated configuration is cached in config_dir.
+# If no file has been touched since, the cache is used as-is.
+# If some have been touched but their contents are the same,
+# (hashed with sha256) the cache is still good.
+#
+def load_config(config_dir):
+  paths = [ os.path.join(config_dir, f["file"]) for f in CONFIG_FILES.values() ]
+  cache_path = os.path.join(config_dir, CONFIG_CACHE_FILE)
+
+  stat_key = _stat_key(paths)
+  cache = _read_cache(cache_path)
+
+  if cache and cache["stat_key"] == stat_key:
+    return compile_views(cache["config"])
+
+  contents = []
+  for path in paths:
+    try:
+      with open(path, "rb") as f:
+        contents.append(f.read())
+    except FileNotFoundError:
+      contents.append(None)
+
+  hash_key = tuple( hashlib.sha256(c).hexdigest() if c is not None else None for c in contents )
+
+  if cache and cache["hash_key"] == hash_key and cache["stat_key"][-1] == stat_key[-1]:
+    cache["stat_key"] = stat_key
+    _write_cache(cache_path, cache)
+    return compile_views(cache["config"])
+
+  app_config = {}
+  for (section, f), path, content in zip(CONFIG_FILES.items(), paths, contents):
+    if content is None:
+      if f.get("required", False):
+        raise ConfigError(f"Missing configuration file {path}")
+      app_config[section] = f["default"]
+      continue
+
+    try:
+      app_config[section] = json5.loads(content.decode("utf-8"))
+    except Exception as e:
+      raise ConfigError(f"Unable to parse {path}: {e}")
+
+  app_config = CONFIG_SCHEMA.validate(app_config)
+
+  _write_cache(cache_path, {
+    "version": CONFIG_CACHE_VERSION,
+    "stat_key": stat_key,
+    "hash_key": hash_key,
+    "config": app_config
+  })
+
+  return compile_views(app_config)
+
+
+#
+# Notices when the config files change, so the configuration
+# can be reloaded without restarting.
+#
+class ConfigWatcher(object):
+  def __init__(self, config_dir):
+    self.config_dir = config_dir
+    self._paths = [ os.path.join(config_dir, f["file"]) for f in CONFIG_FILES.values() ]
+    self._stat_key = None
+    self._config = None
+
+  def load(self):
+    self._stat_key = _stat_key(self._paths)
+    self._config = load_config(self.config_dir)
+    return self._config
+
+  #
+  # Returns the new configuration if it has changed since last time,
+  # otherwise None. A broken configuration is reported and ignored,
+  # so a typo doesn't bring everything down.
+  #
+  def poll(self):
+    stat_key = _stat_key(self._paths)
+    if stat_key == self._stat_key:
+      return None
+    self._stat_key = stat_key
+
+    try:
+      new_config = load_config(self.config_dir)
+    except Exception as e:
+      print(f"Not reloading invalid configuration: {e}")
+      return None
+
+    # Saved without any real changes
+    if new_config == self._config:
+      return None
+
+    self._config = new_config
+    return new_config
@@ -52,6 +52,40 @@ def win_set_vol(percentage):
     control.SetMasterVolumeLevel(level, None)
 
 
+def win_listen():
+    # Serve commands from stdin, one per line, until it closes.
+    # This saves starting python and loading pycaw for every change.
+    #   set <percentage>
+    #   change <delta>
+    control = win_get_control()
+
+    for line in sys.stdin:
+        words = line.split()
+        if not words:
+            continue
+
+        try:
+            if len(words) == 1:
+                command, argument = "set", int(words[0])
+            else:
+                command, argument = words[0], int(words[1])
+        except ValueError:
+            print(f"Unable to parse command: {line.strip()}", file=sys.stderr)
+            continue
+
+        if command == "set":
+            percentage = argument
+        elif command == "change":
+            percentage = win_vol_to_perc(control, control.GetMasterVolumeLevel()) + argument
+        else:
+            print(f"Unknown command: {command}", file=sys.stderr)
+            continue
+
+        percentage = min(percentage, 100)
+        percentage = max(percentage, 0)
+        control.SetMasterVolumeLevel(win_perc_to_vol(control, percentage), None)
+
+
 def win_watch_vol():
     control = win_get_control()
     que = queue.Queue()
@@ -102,6 +136,8 @@ get_parser = commands.add_parser("get", help="Get system volume (0-100)")
 set_parser = commands.add_parser("set", help="Set system volume (0-100)")
 set_parser.add_argument("percentage", nargs=1, type=int, help="Exact volume level to set 0 - 100, inclusive")
 
+listen_parser = commands.add_parser("listen", help="Read \"set <percentage>\" or \"change <delta>\" commands from stdin, one per line")
+
 change_parser = commands.add_parser("change", help="Change system volume (relative)")
 change_parser.add_argument("delta", nargs=1, type=int, help="Desired change in volume (relative), -100 - +100, inclusive")
 
@@ -111,6 +147,8 @@ if conf.command == "get":
     print(win_get_vol())
 elif conf.command == "watch":
     win_watch_vol()
+elif conf.command == "listen":
+    win_listen()
 elif conf.command == "set":
     win_set_vol(conf.percentage[0])
 elif conf.command == "change":
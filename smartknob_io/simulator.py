@@ -0,0 +1,359 @@
+#
+# A pure-python stand-in for a SmartKnob running its firmware.
+# Speaks the same COBS + CRC32 + protobuf protocol as a real knob,
+# either over an in-memory loopback "serial port" or a pty pair,
+# so everything can be exercised without hardware.
+#
+#   python -m smartknob_io.simulator --rate 1000
+#
+# prints the path of a pty which any serial client can open.
+#
+
+from cobs import cobs
+import argparse
+import logging
+import os
+import random
+import select
+import sys
+from threading import (
+    Condition,
+    Event,
+    Lock,
+    Thread,
+)
+import time
+import zlib
+
+# Importing smartknob_io first puts proto_gen on the path for the generated code
+from .smartknob_io import PROTOBUF_PROTOCOL_VERSION
+from .proto_gen import smartknob_pb2
+
+
+class LoopbackSerial(object):
+    """
+    One end of an in-memory serial line.
+    Implements the parts of the pyserial API that Smartknob uses.
+    """
+
+    def __init__(self, timeout=1.0):
+        self.timeout = timeout
+        self.peer = None
+        self.is_open = True
+        self._buffer = bytearray()
+        self._cond = Condition()
+
+    def _receive(self, data):
+        with self._cond:
+            self._buffer += data
+            self._cond.notify_all()
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            return len(self._buffer)
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        with self._cond:
+            while len(self._buffer) < size and self.is_open:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            return data
+
+    def write(self, data):
+        if self.is_open and self.peer.is_open:
+            self.peer._receive(bytes(data))
+        return len(data)
+
+    def close(self):
+        with self._cond:
+            self.is_open = False
+            self._cond.notify_all()
+
+    def setRTS(self, value):
+        pass
+
+    def setDTR(self, value):
+        pass
+
+
+def loopback_serial_pair(timeout=1.0):
+    """
+    Returns (host_end, knob_end), two connected LoopbackSerial objects
+    """
+    host_end = LoopbackSerial(timeout)
+    knob_end = LoopbackSerial(timeout)
+    host_end.peer = knob_end
+    knob_end.peer = host_end
+    return host_end, knob_end
+
+
+class PtySerial(object):
+    """
+    The knob's end of a pty pair. The host opens slave_path like any serial port.
+    """
+
+    def __init__(self, timeout=1.0):
+        import pty
+        import tty
+
+        self.timeout = timeout
+        self.is_open = True
+        self._master_fd, slave_fd = pty.openpty()
+        tty.setraw(self._master_fd)
+        tty.setraw(slave_fd)
+        self.slave_path = os.ttyname(slave_fd)
+
+        # Keep the slave end open, or the master will see EOF/EIO
+        # whenever no client happens to have the port open.
+        self._slave_fd = slave_fd
+
+    @property
+    def in_waiting(self):
+        readable, _, _ = select.select([self._master_fd], [], [], 0)
+        return 1 if readable else 0
+
+    def read(self, size=1):
+        readable, _, _ = select.select([self._master_fd], [], [], self.timeout)
+        if not readable or not self.is_open:
+            return b''
+        try:
+            return os.read(self._master_fd, max(size, 4096))
+        except OSError:
+            return b''
+
+    def write(self, data):
+        return os.write(self._master_fd, data)
+
+    def close(self):
+        self.is_open = False
+        os.close(self._master_fd)
+        os.close(self._slave_fd)
+
+
+class SimulatedSmartknob(object):
+    """
+    Behaves like a SmartKnob on the other end of a serial line.
+
+    - ACKs every valid message it receives
+    - Applies configs, with the firmware's position_nonce semantics
+    - Sends SmartKnobState at state_rate Hz, with sub_position_unit jittering
+      by up to +/- jitter, as well as immediately after any change
+    - Drops drop_rate of the frames in each direction
+      and corrupts corrupt_rate of the frames it sends
+    """
+
+    def __init__(self, stream, state_rate=50, jitter=0.02, drop_rate=0.0, corrupt_rate=0.0, seed=None):
+        self._stream = stream
+        self._logger = logging.getLogger('smartknob.simulator')
+        self._random = random.Random(seed)
+        self.state_rate = state_rate
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+
+        self._lock = Lock()
+        self._write_lock = Lock()
+        self._stop = Event()
+        self._threads = []
+
+        self.config = smartknob_pb2.SmartKnobConfig()
+        self.config.min_position = 0
+        self.config.max_position = 10
+        self.config.position_width_radians = 0.17
+        self.config.text = "Simulated"
+        self.current_position = 0
+        self.press_nonce = 0
+
+        self.stats = {
+            "frames_received": 0,
+            "bad_frames_received": 0,
+            "frames_dropped": 0,
+            "frames_corrupted": 0,
+            "acks_sent": 0,
+            "states_sent": 0,
+            "configs_applied": 0,
+        }
+
+    def _frame(self, message):
+        payload = bytearray(message.SerializeToString())
+        payload += (zlib.crc32(payload) & 0xffffffff).to_bytes(4, 'little')
+        encoded = bytearray(cobs.encode(payload))
+
+        if self.corrupt_rate and self._random.random() < self.corrupt_rate:
+            # Never produce a zero, that would split the frame in two
+            i = self._random.randrange(len(encoded))
+            encoded[i] = (encoded[i] % 255) + 1
+            self.stats["frames_corrupted"] += 1
+
+        return bytes(encoded) + b'\0'
+
+    def _send(self, message):
+        if self.drop_rate and self._random.random() < self.drop_rate:
+            self.stats["frames_dropped"] += 1
+            return
+
+        frame = self._frame(message)
+        with self._write_lock:
+            self._stream.write(frame)
+
+    def _send_state(self):
+        message = smartknob_pb2.FromSmartKnob()
+        message.protocol_version = PROTOBUF_PROTOCOL_VERSION
+
+        with self._lock:
+            state = message.smartknob_state
+            state.current_position = self.current_position
+            state.sub_position_unit = self._random.uniform(-self.jitter, self.jitter)
+            state.press_nonce = self.press_nonce
+            state.config.CopyFrom(self.config)
+
+        self._send(message)
+        self.stats["states_sent"] += 1
+
+    def _send_ack(self, nonce):
+        message = smartknob_pb2.FromSmartKnob()
+        message.protocol_version = PROTOBUF_PROTOCOL_VERSION
+        message.ack.nonce = nonce
+        self._send(message)
+        self.stats["acks_sent"] += 1
+
+    def _apply_config(self, config):
+        with self._lock:
+            # Like the firmware, only jump to the configured position
+            # if the host changed position_nonce.
+            if config.position_nonce != self.config.position_nonce:
+                self.current_position = config.position
+            self.config.CopyFrom(config)
+            self.current_position = max(self.current_position, config.min_position)
+            if config.max_position >= config.min_position:
+                self.current_position = min(self.current_position, config.max_position)
+        self.stats["configs_applied"] += 1
+
+    def _process_frame(self, frame):
+        self.stats["frames_received"] += 1
+
+        if self.drop_rate and self._random.random() < self.drop_rate:
+            self.stats["frames_dropped"] += 1
+            return
+
+        try:
+            decoded = cobs.decode(frame)
+        except cobs.DecodeError:
+            self.stats["bad_frames_received"] += 1
+            return
+
+        if len(decoded) < 4 or zlib.crc32(decoded[:-4]) & 0xffffffff != int.from_bytes(decoded[-4:], 'little'):
+            self.stats["bad_frames_received"] += 1
+            return
+
+        message = smartknob_pb2.ToSmartknob()
+        message.ParseFromString(decoded[:-4])
+        self._send_ack(message.nonce)
+
+        payload_type = message.WhichOneof('payload')
+        if payload_type == 'smartknob_config':
+            self._apply_config(message.smartknob_config)
+            self._send_state()
+        elif payload_type == 'request_state':
+            self._send_state()
+
+    def _read_loop(self):
+        buffer = bytearray()
+        while not self._stop.is_set():
+            data = self._stream.read(max(1, self._stream.in_waiting))
+            if not data:
+                continue
+
+            buffer += data
+            start = 0
+            while True:
+                end = buffer.find(0, start)
+                if end < 0:
+                    break
+                if end > start:
+                    self._process_frame(bytes(buffer[start:end]))
+                start = end + 1
+            del buffer[:start]
+
+    def _state_loop(self):
+        next_state = time.perf_counter()
+        while not self._stop.is_set():
+            if self.state_rate:
+                self._send_state()
+                next_state += 1.0 / self.state_rate
+                delay = next_state - time.perf_counter()
+
+                # Don't try to catch up if we've fallen far behind
+                if delay < -0.1:
+                    next_state = time.perf_counter()
+            else:
+                delay = 0.1
+
+            if delay > 0:
+                self._stop.wait(delay)
+
+    def rotate(self, steps):
+        with self._lock:
+            position = self.current_position + steps
+            position = max(position, self.config.min_position)
+            if self.config.max_position >= self.config.min_position:
+                position = min(position, self.config.max_position)
+            self.current_position = position
+        self._send_state()
+
+    def press(self):
+        with self._lock:
+            self.press_nonce = (self.press_nonce + 1) & 0xff
+        self._send_state()
+
+    def start(self):
+        self._threads = [
+            Thread(target=self._read_loop, daemon=True),
+            Thread(target=self._state_loop, daemon=True),
+        ]
+        for t in self._threads:
+            t.start()
+
+    def stop(self):
+        self._stop.set()
+        for t in self._threads:
+            t.join()
+
+
+def _run_simulator():
+    parser = argparse.ArgumentParser("Simulate a SmartKnob on a pty")
+    parser.add_argument("--rate", type=float, default=50, help="State messages per second")
+    parser.add_argument("--jitter", type=float, default=0.02, help="Max sub_position_unit noise")
+    parser.add_argument("--drop", type=float, default=0.0, help="Fraction of frames to drop")
+    parser.add_argument("--corrupt", type=float, default=0.0, help="Fraction of frames to corrupt")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed")
+    conf = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    stream = PtySerial()
+    knob = SimulatedSmartknob(stream, conf.rate, conf.jitter, conf.drop, conf.corrupt, conf.seed)
+    knob.start()
+    print(f"Simulated smartknob on {stream.slave_path}")
+    sys.stdout.flush()
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+    knob.stop()
+    stream.close()
+    print(knob.stats)
+
+
+if __name__ == '__main__':
+    _run_simulator()
@@ -7,9 +7,16 @@ if __name__ == '__main__':
 from cobs import cobs
 from collections import (
     defaultdict,
+    deque,
+    OrderedDict,
+)
+from contextlib import (
+    asynccontextmanager,
+    contextmanager,
 )
-from contextlib import contextmanager
 from enum import Enum
+import abc
+import asyncio
 import logging
 import os
 from queue import (
@@ -33,60 +40,112 @@ sys.path.append(os.path.join(software_root, 'proto_gen'))
 
 # This import has been changed to work in a package hierarchy.
 from .proto_gen import smartknob_pb2
+from .transport import (
+    AsyncioSerialTransport,
+    ThreadedSerialTransport,
+)
 
 SMARTKNOB_BAUD = 921600
 PROTOBUF_PROTOCOL_VERSION = 1
 
 
-class Smartknob(object):
-    RETRY_TIMEOUT = 0.25
+def _varint(value):
+    # Negative int32s are sign extended to 64 bits, like protobuf does
+    if value < 0:
+        value += 1 << 64
+
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _varint_field(field_number, value):
+    return _varint(field_number << 3) + _varint(value)
+
+
+def patch_config_position(config_bytes, position, position_nonce):
+    """
+    Takes a serialized SmartKnobConfig and returns it with position and
+    position_nonce set. Protobuf lets later fields override earlier ones,
+    so a pre-serialized config can be reused without parsing it.
+    """
+    return (config_bytes +
+            _varint_field(smartknob_pb2.SmartKnobConfig.POSITION_FIELD_NUMBER, position) +
+            _varint_field(smartknob_pb2.SmartKnobConfig.POSITION_NONCE_FIELD_NUMBER, position_nonce))
+
 
-    def __init__(self, serial_instance):
-        self._serial = serial_instance
+class _SmartknobProtocol(abc.ABC):
+    """
+    Framing, encoding and message dispatch shared by Smartknob and AsyncSmartknob.
+    Bytes from the transport go into _feed(), ACKs come out through _on_ack().
+    """
+
+    # How many messages may be awaiting an ACK at the same time
+    WINDOW_SIZE = 4
+
+    # Anything longer than this without a delimiter is line noise
+    MAX_FRAME_LENGTH = 4096
+
+    def __init__(self, transport):
+        self._transport = transport
+        self._serial = transport.serial
         self._logger = logging.getLogger('smartknob')
-        self._out_q = Queue()
-        self._ack_q = Queue()
         self._next_nonce = randint(0, 255)
-        self._run = True
+        self._read_buffer = bytearray()
+
+        self._out_lock = Lock()
 
         self._lock = Lock()
         self._message_handlers = defaultdict(list)
 
-    def _read_loop(self):
-        self._logger.debug('Read loop started')
-        buffer = b''
-        while True:
-            buffer += self._serial.read_until(b'\0')
-            if not self._run:
-                return
+    @abc.abstractmethod
+    def _on_ack(self, nonce):
+        pass
 
-            if not len(buffer):
-                continue
+    def _feed(self, data):
+        self._read_buffer += data
+        self._process_buffer(self._read_buffer)
 
-            if not buffer.endswith(b'\0'):
-                continue
-            
-            self._process_frame(buffer[:-1])
-            buffer = b''
+    def _process_buffer(self, buffer):
+        # Decode every complete frame in the buffer, then drop them
+        # from its front in a single operation.
+        # The partial frame at the end is kept for the next read.
+        start = 0
+        while True:
+            end = buffer.find(0, start)
+            if end < 0:
+                break
+
+            # The cobs decoder doesn't take memoryviews,
+            # so this is the one copy each frame gets.
+            if end > start:
+                self._process_frame(buffer[start:end])
+            start = end + 1
+
+        if start:
+            del buffer[:start]
+        elif len(buffer) > self.MAX_FRAME_LENGTH:
+            self._logger.debug(f'Discarding {len(buffer)} bytes without a frame delimiter')
+            buffer.clear()
 
     def _process_frame(self, frame):
         try:
             decoded = cobs.decode(frame)
         except cobs.DecodeError:
             self._logger.debug(f'Failed decode ({len(frame)} bytes)')
-            self._logger.debug(frame)
+            self._logger.debug(bytes(frame))
             return
 
         if len(decoded) < 4:
             return
 
-        payload = decoded[:-4]
+        payload = memoryview(decoded)[:-4]
         expected_crc = zlib.crc32(payload) & 0xffffffff
-        provided_crc = (decoded[-1] << 24) \
-                        | (decoded[-2] << 16) \
-                        | (decoded[-3] << 8) \
-                        | decoded[-4]
-        
+        provided_crc = int.from_bytes(decoded[-4:], 'little')
+
         if expected_crc != provided_crc:
             self._logger.debug(f'Bad CRC. expected={hex(expected_crc)}, actual={hex(provided_crc)}')
             return
@@ -99,10 +158,9 @@ class Smartknob(object):
 
         payload_type = message.WhichOneof('payload')
 
-        # If this is an ack, notify the write thread
+        # If this is an ack, notify the sender
         if payload_type == 'ack':
-            nonce = message.ack.nonce
-            self._ack_q.put(nonce)
+            self._on_ack(message.ack.nonce)
 
         with self._lock:
             for handler in self._message_handlers[payload_type] + self._message_handlers[None]:
@@ -111,105 +169,417 @@ class Smartknob(object):
                 except:
                     self._logger.warning(f'Unhandled exception in message handler ({payload_type})', exc_info=True)
     
+    def _take_nonce(self):
+        with self._out_lock:
+            nonce = self._next_nonce
+            self._next_nonce += 1
+        return nonce
+
+    def _encode_message(self, message):
+        nonce = self._take_nonce()
+
+        message.protocol_version = PROTOBUF_PROTOCOL_VERSION
+        message.nonce = nonce
+
+        return (nonce, message.WhichOneof('payload'), self._encode_payload(message.SerializeToString()))
+
+    def _encode_config_bytes(self, config_bytes):
+        # Builds the ToSmartknob around an already serialized config.
+        # The field order may differ from _encode_message, the message doesn't.
+        nonce = self._take_nonce()
+
+        payload = (_varint_field(smartknob_pb2.ToSmartknob.PROTOCOL_VERSION_FIELD_NUMBER, PROTOBUF_PROTOCOL_VERSION) +
+                   _varint_field(smartknob_pb2.ToSmartknob.NONCE_FIELD_NUMBER, nonce) +
+                   _varint((smartknob_pb2.ToSmartknob.SMARTKNOB_CONFIG_FIELD_NUMBER << 3) | 2) +
+                   _varint(len(config_bytes)) +
+                   config_bytes)
+
+        return (nonce, 'smartknob_config', self._encode_payload(payload))
+
+    def _encode_payload(self, payload):
+        payload = bytearray(payload)
+
+        crc = zlib.crc32(payload) & 0xffffffff
+        payload.append(crc & 0xff)
+        payload.append((crc >> 8) & 0xff)
+        payload.append((crc >> 16) & 0xff)
+        payload.append((crc >> 24) & 0xff)
+
+        return cobs.encode(payload)
+
+    def add_handler(self, message_type, handler):
+        with self._lock:
+            self._message_handlers[message_type].append(handler)
+        return lambda: self._remove_handler(message_type, handler)
+
+    def _remove_handler(self, message_type, handler):
+        with self._lock:
+            self._message_handlers[message_type].remove(handler)
+
+    def hard_reset(self):
+        self._serial.setRTS(True)
+        self._serial.setDTR(False)
+        time.sleep(0.2)
+        self._serial.setDTR(True)
+        time.sleep(0.2)
+
+
+class Smartknob(_SmartknobProtocol):
+    RETRY_TIMEOUT = 0.25
+
+    # Placed in the output queue instead of an encoded message
+    # when a coalesced config is waiting to be sent
+    _PENDING_CONFIG = object()
+
+    def __init__(self, serial_instance=None, coalesce_config=False, transport=None):
+        # By default, a thread reads from the serial port
+        if transport is None:
+            transport = ThreadedSerialTransport(serial_instance)
+        super().__init__(transport)
+
+        self._out_q = Queue()
+        self._ack_q = Queue()
+        self._run = True
+
+        # If enabled, a config which hasn't been sent yet is replaced
+        # by newer ones, so only the most recent config goes out.
+        self._coalesce_config = coalesce_config
+        self._pending_config = None
+
+    @property
+    def read_thread(self):
+        # The read thread belongs to the transport now, if it has one
+        return getattr(self._transport, 'read_thread', None)
+
+    def _on_ack(self, nonce):
+        self._ack_q.put(nonce)
+
+    def _write_frame(self, encoded_message):
+        self._transport.write(encoded_message + b'\0')
+
     def _write_loop(self):
         self._logger.debug('Write loop started')
+
+        # Messages which have been sent but not yet ACKed, oldest first.
+        # nonce -> [encoded_message, next_retry, payload_type, on_ack]
+        in_flight = OrderedDict()
+
         while True:
-            data = self._out_q.get()
-            # Check for shutdown
-            if not self._run:
-                self._logger.debug('Write loop exiting @ _out_q')
-                return
-            (nonce, encoded_message) = data
-
-            next_retry = 0
-            while True:
-                if time.time() >= next_retry:
-                    if next_retry > 0:
-                        self._logger.debug('Retry write...')
-                    self._serial.write(encoded_message)
-                    self._serial.write(b'\0')
-                    next_retry = time.time() + Smartknob.RETRY_TIMEOUT
-                
+            # Fill up the window with new messages. Only block waiting for
+            # new messages if there is nothing to retry.
+            while len(in_flight) < Smartknob.WINDOW_SIZE:
                 try:
-                    latest_ack_nonce = self._ack_q.get(timeout=next_retry - time.time())
+                    data = self._out_q.get(block=not in_flight)
                 except Empty:
-                    latest_ack_nonce = None
+                    break
 
                 # Check for shutdown
                 if not self._run:
-                    self._logger.debug('Write loop exiting @ _ack_q')
+                    self._logger.debug('Write loop exiting @ _out_q')
                     return
 
-                if latest_ack_nonce == nonce:
-                    break
-                else:
-                    self._logger.debug(f'Got unexpected nonce: {latest_ack_nonce}')
-    
-    def _enqueue_message(self, message):
-        nonce = self._next_nonce
-        self._next_nonce += 1
+                if data is Smartknob._PENDING_CONFIG:
+                    data = self._take_pending_config()
+                (nonce, payload_type, encoded_message, on_ack) = data
 
-        message.protocol_version = PROTOBUF_PROTOCOL_VERSION
-        message.nonce = nonce
+                # A newer config replaces the whole knob configuration, so
+                # there's no point in retrying an older one. Worse, a late
+                # retry could overwrite the newer config on the knob.
+                if payload_type == 'smartknob_config':
+                    for stale in [n for n, e in in_flight.items() if e[2] == payload_type]:
+                        self._logger.debug(f'Config {stale} superseded by {nonce}')
+                        del in_flight[stale]
 
-        payload = bytearray(message.SerializeToString())
+                self._write_frame(encoded_message)
+                in_flight[nonce] = [encoded_message, time.time() + Smartknob.RETRY_TIMEOUT, payload_type, on_ack]
 
-        crc = zlib.crc32(payload) & 0xffffffff
-        payload.append(crc & 0xff)
-        payload.append((crc >> 8) & 0xff)
-        payload.append((crc >> 16) & 0xff)
-        payload.append((crc >> 24) & 0xff)
+            if not in_flight:
+                continue
 
-        encoded_message = cobs.encode(payload)
+            next_retry = min(e[1] for e in in_flight.values())
+            try:
+                latest_ack_nonce = self._ack_q.get(timeout=max(0, next_retry - time.time()))
+            except Empty:
+                latest_ack_nonce = None
 
-        self._out_q.put((nonce, encoded_message))
+            # Check for shutdown
+            if not self._run:
+                self._logger.debug('Write loop exiting @ _ack_q')
+                return
+
+            # ACKs may arrive in any order
+            if latest_ack_nonce is not None:
+                entry = in_flight.pop(latest_ack_nonce, None)
+                if entry is None:
+                    self._logger.debug(f'Got unexpected nonce: {latest_ack_nonce}')
+                elif entry[3] is not None:
+                    try:
+                        entry[3](latest_ack_nonce)
+                    except:
+                        self._logger.warning('Unhandled exception in ACK callback', exc_info=True)
+
+            now = time.time()
+            for entry in in_flight.values():
+                if now >= entry[1]:
+                    self._logger.debug('Retry write...')
+                    self._write_frame(entry[0])
+                    entry[1] = now + Smartknob.RETRY_TIMEOUT
+
+    def _put_out_q(self, data):
+        self._out_q.put(data)
+
+        # The write loop may be waiting for ACKs with a free slot
+        # in its window. Wake it up so the new message goes out right away.
+        self._ack_q.put(None)
 
         approx_q_length = self._out_q.qsize()
         self._logger.debug(f'Out q length: {approx_q_length}')
         if approx_q_length > 10:
             self._logger.warning(f'Output queue length is high! ({approx_q_length}) Is the smartknob still connected and functional?')
 
-    def set_config(self, config):
+    def _enqueue_message(self, message, on_ack=None):
+        self._put_out_q(self._encode_message(message) + (on_ack,))
+
+    def _take_pending_config(self):
+        with self._out_lock:
+            config, on_ack = self._pending_config
+            self._pending_config = None
+
+        if isinstance(config, bytes):
+            return self._encode_config_bytes(config) + (on_ack,)
+        return self._encode_message(config) + (on_ack,)
+
+    def _queue_config(self, config, on_ack):
+        # Encoding is deferred until the write loop picks the config up,
+        # so configs which get replaced are never serialized at all.
+        with self._out_lock:
+            already_queued = self._pending_config is not None
+            self._pending_config = (config, on_ack)
+
+        if already_queued:
+            self._logger.debug('Replaced pending config')
+        else:
+            self._put_out_q(Smartknob._PENDING_CONFIG)
+
+    def set_config(self, config, on_ack=None):
+        """
+        Send a config to the knob.
+        on_ack(nonce) is called from the write thread once the knob has ACKed it.
+        A config which is superseded by a newer one before that never gets a call.
+        """
         message = smartknob_pb2.ToSmartknob()
         message.smartknob_config.CopyFrom(config)
-        self._enqueue_message(message)
+
+        if not self._coalesce_config:
+            self._enqueue_message(message, on_ack)
+            return
+
+        self._queue_config(message, on_ack)
+
+    def set_config_bytes(self, config_bytes, on_ack=None):
+        """
+        Like set_config(), for an already serialized SmartKnobConfig,
+        e.g. from patch_config_position().
+        """
+        config_bytes = bytes(config_bytes)
+
+        if not self._coalesce_config:
+            self._put_out_q(self._encode_config_bytes(config_bytes) + (on_ack,))
+            return
+
+        self._queue_config(config_bytes, on_ack)
 
     def start(self):
-        self.read_thread = Thread(target=self._read_loop)
+        self._transport.start(self._feed)
         self.write_thread = Thread(target=self._write_loop)
-        self.read_thread.start()
         self.write_thread.start()
     
     def shutdown(self):
         self._logger.info('Shutting down...')
         self._run = False
-        self.read_thread.join()
-        self._logger.debug('Read thread terminated')
+        self._transport.close()
         self._out_q.put(None)
         self._ack_q.put(None)
         self.write_thread.join()
         self._logger.debug('Write thread terminated')
     
-    def add_handler(self, message_type, handler):
-        with self._lock:
-            self._message_handlers[message_type].append(handler)
-        return lambda: self._remove_handler(message_type, handler)
+    def request_state(self):
+        message = smartknob_pb2.ToSmartknob()
+        message.request_state.SetInParent()
+        self._enqueue_message(message)
 
-    def _remove_handler(self, message_type, handler):
-        with self._lock:
-            self._message_handlers[message_type].remove(handler)
+
+class AsyncSmartknob(_SmartknobProtocol):
+    """
+    A smartknob driven entirely by an asyncio event loop.
+    Many knobs can share one loop, without any threads of their own.
+
+    Methods may be called from any thread. From the loop's thread,
+    set_config(), set_config_bytes() and request_state() return futures which
+    complete when the knob has ACKed the message. From any other thread,
+    they return a concurrent.futures.Future for the same thing.
+    """
+    RETRY_TIMEOUT = 0.25
+
+    def __init__(self, transport, coalesce_config=False):
+        super().__init__(transport)
+        self._loop = transport.loop
+        self._coalesce_config = coalesce_config
+
+        # Messages waiting for a free slot in the window, oldest first.
+        # Each entry is [payload_type, message or config bytes, future, on_ack]
+        self._waiting = deque()
+
+        # Messages which have been sent but not yet ACKed, oldest first.
+        # nonce -> [encoded_message, retry_handle, payload_type, futures, on_ack]
+        self._in_flight = OrderedDict()
+
+    def _in_loop_thread(self):
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    async def _call_async(self, fn, *args):
+        return await fn(*args)
+
+    def _call_in_loop(self, fn, *args):
+        # fn returns a future of the loop
+        if self._in_loop_thread():
+            return fn(*args)
+        return asyncio.run_coroutine_threadsafe(self._call_async(fn, *args), self._loop)
+
+    def _on_ack(self, nonce):
+        entry = self._in_flight.pop(nonce, None)
+        if entry is None:
+            self._logger.debug(f'Got unexpected nonce: {nonce}')
+            return
+
+        entry[1].cancel()
+        for future in entry[3]:
+            if not future.done():
+                future.set_result(nonce)
+
+        if entry[4] is not None:
+            try:
+                entry[4](nonce)
+            except:
+                self._logger.warning('Unhandled exception in ACK callback', exc_info=True)
+
+        self._fill_window()
+
+    def _write_frame(self, encoded_message):
+        self._transport.write(encoded_message + b'\0')
+
+    def _retry(self, nonce):
+        entry = self._in_flight.get(nonce, None)
+        if entry is None:
+            return
+
+        self._logger.debug('Retry write...')
+        self._write_frame(entry[0])
+        entry[1] = self._loop.call_later(AsyncSmartknob.RETRY_TIMEOUT, self._retry, nonce)
+
+    def _fill_window(self):
+        while self._waiting and len(self._in_flight) < AsyncSmartknob.WINDOW_SIZE:
+            payload_type, message, future, on_ack = self._waiting.popleft()
+            if isinstance(message, bytes):
+                (nonce, payload_type, encoded_message) = self._encode_config_bytes(message)
+            else:
+                (nonce, payload_type, encoded_message) = self._encode_message(message)
+            futures = [ future ]
+
+            # A newer config replaces the whole knob configuration, so
+            # there's no point in retrying an older one.
+            # Whoever was waiting for the old one gets the ACK of the new one,
+            # but its on_ack is never called, like with Smartknob.
+            if payload_type == 'smartknob_config':
+                for stale in [n for n, e in self._in_flight.items() if e[2] == payload_type]:
+                    self._logger.debug(f'Config {stale} superseded by {nonce}')
+                    entry = self._in_flight.pop(stale)
+                    entry[1].cancel()
+                    futures += entry[3]
+
+            self._write_frame(encoded_message)
+            retry_handle = self._loop.call_later(AsyncSmartknob.RETRY_TIMEOUT, self._retry, nonce)
+            self._in_flight[nonce] = [encoded_message, retry_handle, payload_type, futures, on_ack]
+
+    def _enqueue(self, payload_type, message, on_ack):
+        # Replace a config which is still waiting for a slot.
+        # Whoever was waiting for that one gets the ACK of the new one.
+        if self._coalesce_config and payload_type == 'smartknob_config':
+            for entry in self._waiting:
+                if entry[0] == payload_type:
+                    self._logger.debug('Replaced pending config')
+                    entry[1] = message
+                    entry[3] = on_ack
+                    return entry[2]
+
+        future = self._loop.create_future()
+        self._waiting.append([payload_type, message, future, on_ack])
+        self._fill_window()
+        return future
+
+    def set_config(self, config, on_ack=None):
+        """
+        Send a config to the knob.
+        on_ack(nonce) is called from the loop once the knob has ACKed it.
+        A config which is superseded by a newer one before that never gets a call.
+        """
+        message = smartknob_pb2.ToSmartknob()
+        message.smartknob_config.CopyFrom(config)
+        return self._call_in_loop(self._enqueue, 'smartknob_config', message, on_ack)
+
+    def set_config_bytes(self, config_bytes, on_ack=None):
+        """
+        Like set_config(), for an already serialized SmartKnobConfig,
+        e.g. from patch_config_position().
+        """
+        return self._call_in_loop(self._enqueue, 'smartknob_config', bytes(config_bytes), on_ack)
 
     def request_state(self):
         message = smartknob_pb2.ToSmartknob()
         message.request_state.SetInParent()
-        self._enqueue_message(message)
+        return self._call_in_loop(self._enqueue, 'request_state', message, None)
 
-    def hard_reset(self):
-        self._serial.setRTS(True)
-        self._serial.setDTR(False)
-        time.sleep(0.2)
-        self._serial.setDTR(True)
-        time.sleep(0.2)
+    async def wait_for_message(self, message_type, timeout=None):
+        future = self._loop.create_future()
+
+        def _handler(message):
+            if not future.done():
+                future.set_result(message)
+
+        unregister = self.add_handler(message_type, _handler)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            unregister()
+
+    def start(self):
+        self._transport.start(self._feed)
+
+    def _shutdown(self):
+        self._transport.close()
+
+        for entry in self._in_flight.values():
+            entry[1].cancel()
+            for future in entry[3]:
+                future.cancel()
+        for entry in self._waiting:
+            entry[2].cancel()
+        self._in_flight.clear()
+        self._waiting.clear()
+
+    def shutdown(self):
+        self._logger.info('Shutting down...')
+        if self._in_loop_thread():
+            self._shutdown()
+        elif not self._loop.is_closed():
+            async def _shutdown_in_loop():
+                self._shutdown()
+
+            # Wait for it, so the port can be closed afterwards
+            asyncio.run_coroutine_threadsafe(_shutdown_in_loop(), self._loop).result(timeout=1.0)
 
 
 @contextmanager
@@ -242,6 +612,30 @@ def smartknob_context(serial_port, default_logging=True, wait_for_comms=True):
             s.shutdown()
 
 
+@asynccontextmanager
+async def async_smartknob_context(serial_port, loop=None, default_logging=True, wait_for_comms=True):
+    if loop is None:
+        loop = asyncio.get_running_loop()
+
+    with serial.Serial(serial_port, SMARTKNOB_BAUD, timeout=0) as ser:
+        s = AsyncSmartknob(AsyncioSerialTransport(ser, loop))
+        s.start()
+
+        if default_logging:
+            s.add_handler('log', lambda msg: s._logger.info(f'From smartknob: {msg.msg}'))
+
+        try:
+            if wait_for_comms:
+                s._logger.info('Connecting to smartknob...')
+                s.request_state()
+                await s.wait_for_message('smartknob_state')
+                s._logger.info('Connected!')
+
+            yield s
+        finally:
+            s.shutdown()
+
+
 def ask_for_serial_port():
     """
     Helper function to ask which port to use via stdin
@@ -0,0 +1,188 @@
+if __name__ == '__main__':
+    import sys
+    sys.exit('This is a library file to be imported into your own python scripts. It doesn\'t do anything if run directly')
+
+
+import abc
+import asyncio
+import logging
+import os
+import serial
+import threading
+from threading import Thread
+
+
+class Transport(abc.ABC):
+    """
+    Moves raw bytes between a smartknob and the host.
+
+    Received data is passed, in order, to the callback given to start().
+    The transport decides which thread (or event loop) that happens on.
+    """
+
+    def __init__(self, serial_instance):
+        self.serial = serial_instance
+        self._logger = logging.getLogger('smartknob')
+
+    @abc.abstractmethod
+    def start(self, on_data):
+        pass
+
+    @abc.abstractmethod
+    def write(self, data):
+        pass
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+
+class ThreadedSerialTransport(Transport):
+    """
+    Reads the serial port from a dedicated thread.
+    Writes block the calling thread.
+    """
+
+    def __init__(self, serial_instance):
+        super().__init__(serial_instance)
+        self._run = True
+        self.read_thread = None
+
+    def _read_loop(self, on_data):
+        self._logger.debug('Read loop started')
+        while True:
+            # Take everything that's already arrived in one go.
+            # If nothing has, block (up to the port's timeout) for one byte.
+            try:
+                data = self.serial.read(max(1, self.serial.in_waiting))
+            except (serial.SerialException, OSError):
+                # Most likely unplugged. Nothing more will arrive.
+                if self._run:
+                    self._logger.warning('Failed to read from serial port', exc_info=True)
+                return
+
+            if not self._run:
+                return
+
+            if not data:
+                continue
+
+            on_data(data)
+
+    def start(self, on_data):
+        self.read_thread = Thread(target=self._read_loop, args=(on_data,))
+        self.read_thread.start()
+
+    def write(self, data):
+        try:
+            self.serial.write(data)
+        except (serial.SerialException, OSError):
+            # Most likely unplugged. The sender's retries will
+            # keep going until someone shuts the knob down.
+            self._logger.debug('Failed to write to serial port', exc_info=True)
+
+    def close(self):
+        self._run = False
+        if self.read_thread:
+            self.read_thread.join()
+            self._logger.debug('Read thread terminated')
+
+
+class AsyncioSerialTransport(Transport):
+    """
+    Reads and writes the serial port's file descriptor from an asyncio
+    event loop, so any number of knobs can share a single thread.
+
+    Needs a serial port with a file descriptor, so it won't work on Windows.
+    write() may be called from any thread.
+    """
+
+    def __init__(self, serial_instance, loop):
+        super().__init__(serial_instance)
+
+        if not hasattr(serial_instance, 'fileno'):
+            raise ValueError('The asyncio transport needs a serial port with a file descriptor')
+
+        self.loop = loop
+        self._fd = serial_instance.fileno()
+        self._on_data = None
+        self._write_buffer = bytearray()
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._logger.warning('Failed to read from serial port', exc_info=True)
+            self.close()
+            return
+
+        if not data:
+            # The tty has been hung up, most likely unplugged.
+            # It will stay readable from now on, so stop listening.
+            self._logger.warning('Serial port reported readiness to read but returned no data, disconnected')
+            self.close()
+            return
+
+        self._on_data(data)
+
+    def _on_writable(self):
+        try:
+            written = os.write(self._fd, self._write_buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._logger.warning('Failed to write to serial port', exc_info=True)
+            self.close()
+            return
+
+        del self._write_buffer[:written]
+        if not self._write_buffer:
+            self.loop.remove_writer(self._fd)
+
+    def _write(self, data):
+        # Only wait for the port to become writable
+        # if there's already a backlog.
+        if self._write_buffer:
+            self._write_buffer += data
+            return
+
+        self._write_buffer += data
+        self._on_writable()
+        if self._write_buffer:
+            self.loop.add_writer(self._fd, self._on_writable)
+
+    def _in_loop_thread(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def start(self, on_data):
+        self._on_data = on_data
+        if self._in_loop_thread():
+            self.loop.add_reader(self._fd, self._on_readable)
+        else:
+            self.loop.call_soon_threadsafe(self.loop.add_reader, self._fd, self._on_readable)
+
+    def write(self, data):
+        if self._in_loop_thread():
+            self._write(data)
+        else:
+            self.loop.call_soon_threadsafe(self._write, bytes(data))
+
+    def close(self):
+        def _remove():
+            self.loop.remove_reader(self._fd)
+            self.loop.remove_writer(self._fd)
+
+        if self._in_loop_thread():
+            _remove()
+        elif not self.loop.is_closed():
+            done = threading.Event()
+            def _remove_and_signal():
+                _remove()
+                done.set()
+            self.loop.call_soon_threadsafe(_remove_and_signal)
+            done.wait(timeout=1.0)
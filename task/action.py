@@ -1,13 +1,36 @@
 import math
 import os
+import queue
+import signal
 import subprocess
 import re
+import time
 
 import command
 
 NOBBLER_ROOT=os.path.dirname(os.path.dirname(__file__))
 NOBBLER_SCRIPTS_DIR=os.path.join(NOBBLER_ROOT, "scripts")
 
+# How often to check if an action's commands have finished,
+# when there's a newer value waiting for them
+IN_FLIGHT_POLL_DELAY = 0.01
+
+# Commands still running after this many seconds are killed,
+# unless the action has a command_timeout of its own
+COMMAND_TIMEOUT = 10.0
+
+# Dispatch state for each action name
+# Each entry is an object of
+#  pending    do_action commands not yet performed, oldest first
+#  last_run   time.monotonic() when the action was last performed
+#  in_flight  processes started when it was last performed
+_DISPATCH = {}
+
+# Long-lived helpers for "persistent-command" steps,
+# started on first use and fed one line per invocation.
+# Keyed by command line, each entry is a subprocess.Popen
+_PERSISTENT_COMMANDS = {}
+
 def _clamp(value, d_min, d_max):
   value = max(value, d_min)
   value = min(value, d_max)
@@ -20,6 +43,20 @@ def _change_range(value, s_min, s_max, d_min, d_max):
   return _clamp(absolute, d_min, d_max)
 
 def _rescale(action_config, command):
+  # Relative actions get the number of steps turned.
+  # With scaling [ a, b ], one step ccw is a and one step cw is b.
+  if action_config.get("relative", False):
+    delta = command["delta"]
+    if "scaling" not in action_config:
+      return delta, -abs(delta), abs(delta)
+
+    d_min = action_config["scaling"][0]
+    d_max = action_config["scaling"][1]
+    # Each step counts in full, so deltas which have been added up
+    # scale the same as if they had been run one at a time.
+    scaled = delta * (d_max if delta > 0 else -d_min)
+    return scaled, abs(delta) * d_min, abs(delta) * d_max
+
   # No rescaling configured for this action
   # Just return raw values
   if "scaling" not in action_config:
@@ -50,8 +87,66 @@ def _run_cmd_get_output(cmdline):
   return None
   
 
+def _start_persistent_command(cmdline):
+  print("Starting persistent command:  " + cmdline)
+  proc = subprocess.Popen(cmdline, shell=True, stdin=subprocess.PIPE, text=True, bufsize=1)
+  _PERSISTENT_COMMANDS[cmdline] = proc
+  return proc
+
+def _send_to_persistent_command(cmdline, line):
+  proc = _PERSISTENT_COMMANDS.get(cmdline, None)
+
+  # Start the helper on first use, or if it has died
+  if proc is None or proc.poll() is not None:
+    proc = _start_persistent_command(cmdline)
+
+  for attempt in range(2):
+    try:
+      proc.stdin.write(line + "\n")
+      proc.stdin.flush()
+      return
+    except (BrokenPipeError, OSError):
+      print(f"Persistent command {cmdline} has stopped. Restarting it.")
+      proc = _start_persistent_command(cmdline)
+
+#
+# Stop the persistent commands, except those in keep
+#
+def _stop_persistent_commands(keep=()):
+  for cmdline, proc in list(_PERSISTENT_COMMANDS.items()):
+    if cmdline in keep:
+      continue
+
+    # Helpers are expected to exit when their input closes
+    try:
+      proc.stdin.close()
+    except:
+      pass
+
+    try:
+      proc.wait(timeout=1)
+    except subprocess.TimeoutExpired:
+      proc.terminate()
+
+    del _PERSISTENT_COMMANDS[cmdline]
+
+#
+# Command lines of all the persistent commands the actions use
+#
+def _persistent_cmdlines(actions):
+  return set( step["command"].replace("{scripts}", NOBBLER_SCRIPTS_DIR)
+              for a in actions.values()
+              for step in a["steps"]
+              if step["kind"] == "persistent-command" )
+
+#
+# Performs the steps of an action.
+# Returns the processes started by "command" steps
+#
 def _perform_action(source_knob_id, action_config, received_cmd):
 
+  processes = []
+
   placeholder = action_config.get("placeholder", "{value}")
   do_round = action_config.get("round", False)
 
@@ -78,22 +173,36 @@ def _perform_action(source_knob_id, action_config, received_cmd):
       cmdline = cmdline.replace("{scripts}", NOBBLER_SCRIPTS_DIR)
       print("Invoking system command:  " + cmdline)
 
-      # Run the command, don't wait for a result
-      subprocess.Popen(cmdline, shell=True)
+      # Run the command, don't wait for a result.
+      # In a session of its own, so it can be killed along with its shell.
+      processes.append(subprocess.Popen(cmdline, shell=True, start_new_session=True))
+
+    elif action_kind == "persistent-command":
+
+      cmdline = step.get("command", None)
+      if not cmdline:
+        continue
+
+      # The command line itself stays the same, only the input varies
+      cmdline = cmdline.replace("{scripts}", NOBBLER_SCRIPTS_DIR)
+      line = step.get("input", placeholder).replace(placeholder, str(scaled_value))
+
+      _send_to_persistent_command(cmdline, line)
 
     elif action_kind == "view":
-      # If a knob was specified, apply it to that
+      # If a knob was specified (by name or id), apply it to that
       # If not, use the knob that invoked the action
       knob_id = step.get("knob", received_cmd["knob_id"])
-      # TODO: Knob name translation
 
       new_view = step.get("view", None)
       if not new_view:
         print(f"Unable to find knob view \"{new_view}\"")
-        return
+        break
 
       command.set_view(new_view, knob_id)
 
+  return processes
+
 def _get_action_value(action, d_min, d_max):
       # Not an action we know
       if not action:
@@ -127,6 +236,102 @@ def _get_action_value(action, d_min, d_max):
 
       return value
 
+#
+# Store a do_action command to be performed as soon as its
+# action is allowed to run again.
+# A knob's value replaces a value which is already waiting,
+# so the most recent value always wins. For relative actions,
+# the deltas are added up instead, so no steps are lost.
+# Anything else (e.g. a press) is performed in turn.
+#
+def _schedule(cmd, action_config):
+  # Relative actions only count whole steps, not
+  # the knob moving in between them
+  if action_config.get("relative", False) and cmd["delta"] == 0:
+    return
+
+  entry = _DISPATCH.setdefault(cmd["action"], { "pending": [], "last_run": None, "in_flight": [] })
+  pending = entry["pending"]
+
+  if not (cmd["coalesce"] and pending and pending[-1]["coalesce"]):
+    pending.append(cmd)
+    return
+
+  if action_config.get("relative", False):
+    cmd = dict(cmd, delta=pending[-1]["delta"] + cmd["delta"])
+
+    # Turned back and forth, nothing to do
+    if cmd["delta"] == 0:
+      pending.pop()
+      return
+
+  pending[-1] = cmd
+
+#
+# Kill the commands of an action which have been running for too long
+#
+def _kill_in_flight(action_name, entry):
+  print(f"Commands of action \"{action_name}\" are taking too long. Stopping them.")
+  for p in entry["in_flight"]:
+    try:
+      if hasattr(os, "killpg"):
+        os.killpg(p.pid, signal.SIGKILL)
+      else:
+        p.kill()
+    except OSError:
+      pass
+  entry["in_flight"] = []
+
+#
+# Perform every pending action which is allowed to run.
+# An action runs at most max_rate times per second,
+# and not while the commands from its previous run are still running.
+# Commands which run for longer than the action's command_timeout are killed.
+# Returns how long to wait before trying again, or None if there's nothing to wait for.
+#
+def _dispatch(actions, verbose):
+  now = time.monotonic()
+  timeout = None
+
+  for action_name, entry in _DISPATCH.items():
+    action_config = actions.get(action_name, {})
+
+    entry["in_flight"] = [ p for p in entry["in_flight"] if p.poll() is None ]
+    if entry["in_flight"]:
+      deadline = entry["last_run"] + action_config.get("command_timeout", COMMAND_TIMEOUT)
+      if now >= deadline:
+        _kill_in_flight(action_name, entry)
+
+    if not entry["pending"]:
+      # Come back to kill them if they don't finish
+      if entry["in_flight"]:
+        wait = deadline - now
+        timeout = wait if timeout is None else min(timeout, wait)
+      continue
+
+    if entry["in_flight"]:
+      wait = min(IN_FLIGHT_POLL_DELAY, deadline - now)
+    elif entry["last_run"] is not None and "max_rate" in action_config:
+      wait = entry["last_run"] + 1.0 / action_config["max_rate"] - now
+    else:
+      wait = 0
+
+    if wait > 0:
+      timeout = wait if timeout is None else min(timeout, wait)
+      continue
+
+    if (verbose): print("Performing action: " + str(action_name))
+
+    cmd = entry["pending"].pop(0)
+    entry["last_run"] = now
+    entry["in_flight"] = _perform_action(cmd["knob_id"], action_config, cmd)
+
+    # More of them waiting, in turn
+    if entry["pending"]:
+      timeout = 0
+
+  return timeout
+
 def main(app_config):
 
   verbose = app_config["nobbler"]["verbose"]
@@ -136,19 +341,49 @@ def main(app_config):
   for a in app_config["actions"]:
     actions[a["name"]] = a
 
-  while True:
-    cmd = command.Q_ACTION.get()
-
-    if cmd is None:
-      print("Terminating action task.")
-      break
-
-    if cmd["cmd"] == "do_action":
-      if cmd["action"] not in actions:
-        print(f"Tried to perform unknown action \"{cmd['action']}\". Check your configuration.")
-        continue
-
-      if (verbose): print("Performing action: " + str(cmd["action"]))
-
-      _perform_action(cmd["knob_id"], actions[cmd["action"]], cmd)
-
+  running = True
+  timeout = None
+
+  while running:
+    try:
+      cmd = command.Q_ACTION.get(timeout=timeout)
+    except queue.Empty:
+      cmd = False
+
+    # Take everything that's queued up, so only
+    # the most recent value of each action gets performed
+    while True:
+      if cmd is None:
+        print("Terminating action task.")
+        running = False
+        break
+
+      if cmd and cmd["cmd"] == "config":
+        verbose = cmd["config"]["nobbler"]["verbose"]
+        actions = {}
+        for a in cmd["config"]["actions"]:
+          actions[a["name"]] = a
+
+        # Forget values waiting for actions which are gone
+        for action_name, entry in _DISPATCH.items():
+          if action_name not in actions:
+            entry["pending"] = []
+
+        # Helpers whose command line is still in use keep running
+        _stop_persistent_commands(keep=_persistent_cmdlines(actions))
+
+      elif cmd and cmd["cmd"] == "do_action":
+        if cmd["action"] not in actions:
+          print(f"Tried to perform unknown action \"{cmd['action']}\". Check your configuration.")
+        else:
+          _schedule(cmd, actions[cmd["action"]])
+
+      try:
+        cmd = command.Q_ACTION.get_nowait()
+      except queue.Empty:
+        break
+
+    if running:
+      timeout = _dispatch(actions, verbose)
+
+  _stop_persistent_commands()
@@ -0,0 +1,160 @@
+import select
+import socket
+import threading
+import time
+
+import serial.tools.list_ports
+
+import command
+
+THREAD = None
+THREAD_RUNNING = False
+
+# How often to look for new or removed serial ports
+# when there's no way to be told about them
+PORT_POLLING_DELAY = 2.0
+
+# Even with events, look every now and then, in case one was missed
+EVENT_RESCAN_DELAY = 30.0
+
+# udev needs a moment to create the device node after the kernel's event
+UDEV_SETTLE_DELAY = 0.5
+
+NETLINK_KOBJECT_UEVENT = 15
+
+#
+# Wakes up when the kernel adds or removes a tty device.
+# Only available on Linux.
+#
+class UeventSource(object):
+  def __init__(self):
+    self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+
+    # Multicast group 1 gets the kernel's own events
+    self._socket.bind((0, 1))
+
+  # (action, device path) of a tty being added or removed, or None
+  def _tty_event(self, data):
+    fields = data.split(b'\0')
+    action = fields[0].split(b'@', 1)[0]
+    if action not in [ b'add', b'remove' ] or b'SUBSYSTEM=tty' not in fields:
+      return None
+
+    device = None
+    for f in fields:
+      if f.startswith(b'DEVNAME='):
+        device = "/dev/" + f[len(b'DEVNAME='):].decode(errors="replace")
+
+    return action.decode(), device
+
+  #
+  # Returns (action, device path) when a tty comes or goes,
+  # or None if nothing happened before the timeout
+  #
+  def wait(self, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return None
+
+      readable, _, _ = select.select([self._socket], [], [], remaining)
+      if not readable:
+        return None
+
+      event = self._tty_event(self._socket.recv(65536))
+      if event:
+        return event
+
+  def close(self):
+    self._socket.close()
+
+
+# device -> port info
+def _list_ports():
+  return dict( (p.device, p) for p in serial.tools.list_ports.comports() if p.description != 'n/a' )
+
+#
+# Tells apart what's plugged into a port, so something unplugged
+# and another thing plugged in between two scans is noticed
+#
+def _port_key(port):
+  return (port.device, port.serial_number, port.location)
+
+#
+# Start a thread which watches for serial ports coming and going,
+# and tells the knob task. known_ports are the ports already handled.
+#
+def start_thread(known_ports):
+  global THREAD
+  THREAD = threading.Thread(target=thread_main, args=(dict( (p.device, _port_key(p)) for p in known_ports ),))
+  THREAD.start()
+
+  return THREAD
+
+def stop_thread():
+  global THREAD
+  global THREAD_RUNNING
+
+  if THREAD_RUNNING:
+    THREAD_RUNNING = False
+    THREAD.join()
+    THREAD = None
+
+
+def thread_main(known_ports):
+  global THREAD_RUNNING
+  THREAD_RUNNING = True
+
+  source = None
+  if hasattr(socket, "AF_NETLINK"):
+    try:
+      source = UeventSource()
+    except OSError as e:
+      print(f"Unable to listen for USB events, polling for serial ports instead: {e}")
+
+  next_scan = time.monotonic() + (EVENT_RESCAN_DELAY if source else PORT_POLLING_DELAY)
+
+  # Devices the kernel has removed since the last scan.
+  # They may well be back by the time we look.
+  removed = set()
+
+  while THREAD_RUNNING:
+    # Wake up regularly, to notice if we're asked to stop
+    timeout = min(next_scan - time.monotonic(), 0.5)
+
+    if source:
+      event = source.wait(max(timeout, 0))
+      if event:
+        action, device = event
+        if action == "remove" and device:
+          removed.add(device)
+        time.sleep(UDEV_SETTLE_DELAY)
+        next_scan = time.monotonic()
+    else:
+      time.sleep(max(timeout, 0))
+
+    if time.monotonic() < next_scan:
+      continue
+
+    ports = _list_ports()
+    keys = dict( (device, _port_key(p)) for device, p in ports.items() )
+
+    gone = set( device for device in known_ports
+                  if keys.get(device, None) != known_ports[device] or device in removed )
+
+    # Removals first, so a knob which was renumbered
+    # is let go before it shows up on its new port
+    for portname in sorted(gone):
+      command.serial_port_removed(portname)
+
+    for portname in sorted(keys):
+      if portname not in known_ports or portname in gone:
+        command.serial_port_added(ports[portname])
+
+    known_ports = keys
+    removed.clear()
+    next_scan = time.monotonic() + (EVENT_RESCAN_DELAY if source else PORT_POLLING_DELAY)
+
+  if source:
+    source.close()
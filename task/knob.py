@@ -1,39 +1,124 @@
+import asyncio
 import math
-from queue import Queue, Full
+import threading
+import time
+from queue import Queue, Empty, Full
 import functools
 import serial
 import serial.tools.list_ports
 
 import command
+import task.hotplug
 
 from smartknob_io.smartknob_io import (
+    AsyncSmartknob,
     Smartknob,
     SMARTKNOB_BAUD
 )
-from smartknob_io.proto_gen import smartknob_pb2
+from smartknob_io.transport import AsyncioSerialTransport
+from smartknob_io.simulator import (
+    SimulatedSmartknob,
+    loopback_serial_pair
+)
 
 # The standard python lib for smarknob
 # provides a handler object which
 # starts two threads for the knob.
 # We need to keep track of these to be able
 # to shut down cleanly.
+# Keyed by knob_id, which stays the same when a knob is reconnected.
+# See stable_knob_id().
 # Each entry is an object of
 #  handler
+#  portname
+#  interface                the configured interface it's using
+#  auto                     True if that interface didn't ask for this knob
 #  prev_position
-#  position_nonce
+#  position_nonce           the most recent one we've sent
+#  applied_position_nonce   the most recent one the knob has reported
 #  press_nonce
+#  last_turned              time.monotonic() when the user last turned it
+#  acked_config             (template bytes, position_nonce) of the most recent
+#                           config the knob has ACKed
+#  sent_config              template bytes of the most recent config we've sent
+#  last_seen                (current_position, press_nonce, position_nonce)
+#                           of the last state passed on, owned by the read thread
+#  last_seen_angle          sub-position angle of that state, in radians
+#  sub_position_threshold   radians, or None to ignore sub-position changes
 KNOB_CONNECTION = {}
 
 # Keeps track of which physical interfaces (serial ports)
-# are already in use (= have a handler in KNOB_CONNECTION)
-# so we can skip them during auto-configuration
+# are in use (= have a handler in KNOB_CONNECTION)
+# port name -> knob_id
 KNOB_INTERFACES = {}
 
+# Names given to knobs in the configuration
+# name -> knob_id
+KNOB_NAMES = {}
+
+# After the user has turned a knob, don't move it
+# to reflect changed state for this many seconds
+PUSH_HOLDOFF = 1.0
+
+# Knobs waiting for the first value of an action,
+# so each one asks only once
+# (knob_id, action name)
+VALUE_WAITS = set()
+
+# Values which arrived during the holdoff, to be pushed once it's over
+# (knob_id, action name) -> time.monotonic() when the holdoff ends
+PENDING_PUSHES = {}
+
+# How long a knob gets to answer the first request_state
+HANDSHAKE_TIMEOUT = 3.0
+
+# Threads looking for knobs, and a flag telling them
+# not to hand over any more knobs
+DISCOVERY_THREADS = []
+DISCOVERY_STOP = threading.Event()
+
+# Ports with a handshake in progress
+HANDSHAKING = set()
+
+# Threads letting go of knobs which are no longer used
+RETIRE_THREADS = []
+
+# Knobs simulated in software, which need to be stopped
+# along with their handlers
+SIMULATED_KNOBS = []
+
+# Serial knobs all share this event loop, instead of
+# two threads each. It runs on a thread of its own.
+KNOB_LOOP = None
+KNOB_LOOP_THREAD = None
+
+def start_knob_loop():
+  global KNOB_LOOP
+  global KNOB_LOOP_THREAD
+
+  KNOB_LOOP = asyncio.new_event_loop()
+  KNOB_LOOP_THREAD = threading.Thread(target=KNOB_LOOP.run_forever)
+  KNOB_LOOP_THREAD.start()
+
+def stop_knob_loop():
+  global KNOB_LOOP
+  global KNOB_LOOP_THREAD
+
+  if KNOB_LOOP is None:
+    return
+
+  KNOB_LOOP.call_soon_threadsafe(KNOB_LOOP.stop)
+  KNOB_LOOP_THREAD.join()
+  KNOB_LOOP.close()
+
+  KNOB_LOOP = None
+  KNOB_LOOP_THREAD = None
+
 #
-# Find the first serial port that identifies as the CH340
+# All serial ports which might have a knob on them
 #
-def get_serial_port_auto():
-  ports = sorted(
+def list_serial_ports():
+  return sorted(
       filter(
           lambda p: p.description != 'n/a',
           serial.tools.list_ports.comports(),
@@ -41,46 +126,80 @@ def get_serial_port_auto():
       key=lambda p: p.device,
   )
 
-  for p in ports:
+#
+# An ID for the knob on a serial port which stays the same
+# if the OS renumbers the port.
+# Uses the USB serial number if the chip has one, which also survives
+# plugging the knob into a different USB port. The CH340 usually doesn't
+# have one, and then the USB location (which physical port) is the best we have.
+# Returns None if the port isn't USB, and the port name will have to do.
+#
+def stable_knob_id(port):
+  if port is None or port.vid is None:
+    return None
 
-    # Don't pick a port that we've already configured
-    if p.device in KNOB_INTERFACES:
-      continue
+  usb_id = f"usb-{port.vid:04x}:{port.pid:04x}"
 
-    if "USB-SERIAL CH340" in p.description:
-      print(f"Auto-connecting to serial port {p.device}")
-      return p.device, serial.Serial(p.device, SMARTKNOB_BAUD, timeout=1.0)
+  if port.serial_number:
+    return f"{usb_id}-{port.serial_number}"
 
-  print("No more knobs found for auto-configuration. Specify a serial port or connect another smartknob.")
-  return None, None
-def get_serial_port(portname):
+  if port.location:
+    return f"{usb_id}@{port.location}"
 
-  ports = sorted(
-      filter(
-          lambda p: p.description != 'n/a',
-          serial.tools.list_ports.comports(),
-      ),
-      key=lambda p: p.device,
-  )
+  return None
 
-  for p in ports:
-    if p.device == portname:
-      print(f"Connecting to serial port {p.device}")
-      return serial.Serial(p.device, SMARTKNOB_BAUD, timeout=1.0)
+#
+# Find a knob by its configured name or its knob_id
+#
+def resolve_knob(knob):
+  return KNOB_NAMES.get(knob, knob)
 
-  return None
+#
+# Which configured interface a serial port belongs to.
+# Returns (wanted, interface). Interface is None if the port
+# is only wanted by an interface without a device or id (auto).
+#
+def interface_for_port(interfaces, portname, knob_id, description, auto_available):
+  for i in interfaces:
+    if i["kind"] != "serial":
+      continue
 
-def start_serial(portname):
+    if i.get("id", None) == knob_id or i.get("device", None) == portname:
+      return True, i
 
-  if portname:
-    port = get_serial_port(portname)
-  else:
-    # Auto-select the first port that looks OK
-    portname, port = get_serial_port_auto()
+  if auto_available and is_knob_port(description):
+    return True, None
 
-  if not port: return None, None, None
+  return False, None
 
-  s = Smartknob(port)
+#
+# Interfaces which will take whichever knob comes along
+#
+def is_auto_interface(interface):
+  return interface["kind"] == "serial" and not interface.get("device", None) and not interface.get("id", None)
+
+#
+# Does this look like the USB serial chip on a knob?
+#
+def is_knob_port(description):
+  return "USB-SERIAL CH340" in description
+
+#
+# Start talking to a knob and wait for its first state.
+# Returns (handler, first state), or (None, None) if it doesn't answer in time.
+#
+def connect_knob(port, timeout=None):
+  s = None
+  if KNOB_LOOP is not None:
+    try:
+      s = AsyncSmartknob(AsyncioSerialTransport(port, KNOB_LOOP), coalesce_config=True)
+    except ValueError:
+      # No file descriptor to watch (Windows, or a simulated knob).
+      # That one gets threads of its own.
+      pass
+
+  if s is None:
+    s = Smartknob(port, coalesce_config=True)
   s.start()
 
   s._logger.info('Connecting to smartknob...')
@@ -94,50 +213,279 @@ def start_serial(portname):
   unregister = s.add_handler('smartknob_state', startup_handler)
 
   s.request_state()
-  first_message = q.get()
+  try:
+    first_message = q.get(timeout=timeout)
+  except Empty:
+    first_message = None
   unregister()
+
+  if first_message is None:
+    s.shutdown()
+    return None, None
+
   s._logger.info('Connected!')
 
-  return portname, s, first_message
+  return s, first_message
+
+#
+# Stop a knob's handler and let go of its port
+#
+def retire_handler(handler):
+  try:
+    handler.shutdown()
+  except:
+    pass
+
+  try:
+    handler._serial.close()
+  except:
+    pass
 
+#
+# Like retire_handler(), on a thread of its own.
+# Stopping a handler waits for its threads, which may take
+# as long as the port's read timeout. The knob task can't wait for that.
+#
+def retire_handler_later(handler):
+  t = threading.Thread(target=retire_handler, args=(handler,))
+  t.start()
 
-def message_from_knob(queue, knob_id, message_type, message):
-  
+  RETIRE_THREADS[:] = [ r for r in RETIRE_THREADS if r.is_alive() ]
+  RETIRE_THREADS.append(t)
 
-  state = KNOB_CONNECTION[knob_id]
+#
+# Runs on a discovery thread if no knob answered
+#
+def knob_not_found(queue, portname):
+  if DISCOVERY_STOP.is_set():
+    return
+
+  cmd = { "cmd": "knob-failed", "portname": portname }
+  queue.put(cmd)
+
+#
+# Runs on a discovery thread once a knob has answered.
+# The knob task takes it from there.
+#
+def knob_found(queue, interface, portname, knob_id, handler, first_status):
+  # Nobody's going to pick it up
+  if DISCOVERY_STOP.is_set():
+    retire_handler(handler)
+    return
+
+  cmd = {
+          "cmd": "knob-online",
+          "interface": interface,
+          "portname": portname,
+          "knob_id": knob_id,
+          "handler": handler,
+          "first_status": first_status
+        }
+  queue.put(cmd)
+
+def handshake_serial(queue, interface, portname, knob_id):
+  try:
+    port = serial.Serial(portname, SMARTKNOB_BAUD, timeout=1.0)
+  except (serial.SerialException, OSError) as e:
+    print(f"Unable to open serial port {portname}: {e}")
+    knob_not_found(queue, portname)
+    return
+
+  handler, first_status = connect_knob(port, HANDSHAKE_TIMEOUT)
+  if not handler:
+    print(f"No knob answered on serial port {portname}.")
+    port.close()
+    knob_not_found(queue, portname)
+    return
+
+  print(f"Found knob {knob_id} on serial port {portname}")
+  knob_found(queue, interface, portname, knob_id, handler, first_status)
+
+def handshake_simulated(queue, interface, portname, knob_id):
+  host_end, knob_end = loopback_serial_pair()
+
+  simulator = SimulatedSmartknob(knob_end,
+                                 state_rate=interface["state_rate"],
+                                 jitter=interface["jitter"],
+                                 drop_rate=interface["drop_rate"],
+                                 corrupt_rate=interface["corrupt_rate"])
+  simulator.start()
+  SIMULATED_KNOBS.append(simulator)
+
+  print(f"Starting simulated knob {portname}")
+
+  handler, first_status = connect_knob(host_end, HANDSHAKE_TIMEOUT)
+  if not handler:
+    print(f"Simulated knob {portname} didn't answer.")
+    knob_not_found(queue, portname)
+    return
+
+  knob_found(queue, interface, portname, knob_id, handler, first_status)
+
+#
+# Handshake with a possible knob on a thread of its own.
+# Returns right away.
+#
+def start_handshake(queue, target, interface, portname, knob_id):
+  HANDSHAKING.add(portname)
+
+  t = threading.Thread(target=target, args=(queue, interface, portname, knob_id))
+  t.start()
+
+  DISCOVERY_THREADS[:] = [ d for d in DISCOVERY_THREADS if d.is_alive() ]
+  DISCOVERY_THREADS.append(t)
+
+#
+# Look for the configured knobs, all at once.
+# Each candidate port gets its own thread for the handshake,
+# and every knob which answers is posted to the queue as "knob-online".
+#
+# Interfaces with an id or device get that knob. Interfaces with
+# neither (auto) get whichever other knob-looking ports answer first,
+# so every one of those is tried.
+#
+# Returns the serial ports which were there to begin with.
+#
+def start_discovery(interfaces, queue):
+  ports = list_serial_ports()
+  auto_available = any( is_auto_interface(i) for i in interfaces )
+
+  candidates = []
+  simulated = 0
+  found_devices = set()
 
+  for i in interfaces:
+    if i["kind"] == "simulated":
+      simulated += 1
+      portname = f"simulated{simulated}"
+      candidates.append((handshake_simulated, i, portname, portname))
+
+  for p in ports:
+    knob_id = stable_knob_id(p) or p.device
+    wanted, interface = interface_for_port(interfaces, p.device, knob_id, p.description, auto_available)
+    if not wanted:
+      continue
+
+    found_devices.add(p.device)
+    print(f"Trying serial port {p.device}")
+    candidates.append((handshake_serial, interface, p.device, knob_id))
+
+  # Not all serial ports are enumerated (e.g. a pty)
+  # but it's fine to try them if they're configured.
+  for i in interfaces:
+    if i["kind"] == "serial" and i.get("device", None) and i["device"] not in found_devices:
+      candidates.append((handshake_serial, i, i["device"], i["device"]))
+
+  if auto_available and not any( is_knob_port(p.description) for p in ports ):
+    print("No knobs found for auto-configuration. Specify a serial port or connect another smartknob.")
+
+  for target, interface, portname, knob_id in candidates:
+    start_handshake(queue, target, interface, portname, knob_id)
+
+  return ports
+
+#
+# Stop discovery. Knobs which were found but never
+# brought online are shut down.
+#
+def stop_discovery(queue):
+  DISCOVERY_STOP.set()
+
+  for t in DISCOVERY_THREADS:
+    t.join()
+
+  while True:
+    try:
+      cmd = queue.get_nowait()
+    except Empty:
+      break
+
+    if cmd and cmd["cmd"] == "knob-online":
+      retire_handler(cmd["handler"])
+
+#
+# Start handling a knob which has answered
+#
+def register_knob(interface, portname, knob_id, handler, first_status, default_view, auto=False):
+  KNOB_INTERFACES[portname] = knob_id
+
+  if interface.get("name", None):
+    KNOB_NAMES[interface["name"]] = knob_id
+
+  threshold = interface.get("sub_position_threshold", None)
+  if threshold is not None:
+    threshold = math.radians(threshold)
+
+  KNOB_CONNECTION[knob_id] = {
+      "handler": handler,
+      "portname": portname,
+      "interface": interface,
+      "auto": auto,
+      "prev_position": first_status.current_position,
+      "position_nonce": first_status.config.position_nonce,
+      "applied_position_nonce": first_status.config.position_nonce,
+      "press_nonce": first_status.press_nonce,
+      "last_turned": 0,
+      "acked_config": None,
+      "sent_config": None,
+      "last_seen": (first_status.current_position,
+                    first_status.press_nonce,
+                    first_status.config.position_nonce),
+      "last_seen_angle": first_status.sub_position_unit * first_status.config.position_width_radians,
+      "sub_position_threshold": threshold,
+      "current_view": default_view
+    }
+
+  for message_type in [ "smartknob_state" ]:
+    # Let each knob's private thread push data messages into the
+    # central handling queue
+    handler.add_handler(message_type, functools.partial(message_from_knob,
+      command.Q_KNOB,
+      knob_id,
+      message_type)
+    )
+
+  # Give the knob a startup configuration
+  apply_knob_view(knob_id, default_view)
+
+  return knob_id
+
+
+def message_from_knob(queue, knob_id, message_type, message):
+  state = KNOB_CONNECTION.get(knob_id, None)
+
+  # The knob has just been unplugged
+  if state is None:
+    return
 
   # We will get -lots- of updates from the knob,
   # since the subposition value jitters.
   # We don't care about those and don't want those events
   # clogging up the event queue slowing down the handling,
   # so we skip them here.
+  # This runs on the knob's read thread for every state,
+  # so only integers are compared. position_nonce changes whenever
+  # the knob applies a config, so that covers config changes too.
 
   if message_type == "smartknob_state":
 
-    compare = lambda value, key: value == state["current_view"]["config"].get(key, value)
-
-    # TODO: This probably isn't a safe comparison.
-    # floating point equality is a finnicky subject.
-    # Ideally, we should have a config_nonce in the knob state.    
-    config_is_same = (
-      compare(message.config.min_position, "min_position") and
-      compare(message.config.max_position, "max_position") and
-      #compare(message.config.position_width_radians, "position_with_radians") and
-      #compare(message.config.detent_strength_unit, "detent_strength_unit") and
-      #compare(message.config.endstop_strength_unit, "endstop_strength_unit") and
-      #compare(message.config.snap_point, "snap_point") and
-      compare(message.config.text, "text") and
-      compare(message.config.led_hue, "led_hue")
-    )
-     
-
-    position_is_same = (message.current_position == state["prev_position"] and
-                        message.press_nonce == state["press_nonce"]
-                       )
-    
-    if config_is_same and position_is_same: return
-    
+    seen = (message.current_position,
+            message.press_nonce,
+            message.config.position_nonce)
+
+    threshold = state["sub_position_threshold"]
+
+    if seen == state["last_seen"]:
+      if threshold is None:
+        return
+
+      angle = message.sub_position_unit * message.config.position_width_radians
+      if abs(angle - state["last_seen_angle"]) <= threshold:
+        return
+
+    state["last_seen"] = seen
+    state["last_seen_angle"] = message.sub_position_unit * message.config.position_width_radians
+
   cmd = { "cmd": "data", "knob_id": knob_id, "message_type": message_type, "message": message }
   queue.put_nowait(cmd)
 
@@ -167,9 +515,17 @@ def handle_data(knob_id, msg):
 
     return
 
+  # The knob has applied a config we sent, which may have moved it.
+  # That's not the user turning the knob.
+  elif msg.config.position_nonce != state["applied_position_nonce"]:
+    state["applied_position_nonce"] = msg.config.position_nonce
+    state["prev_position"] = msg.current_position
+    KNOB_CONNECTION[knob_id] = state
+
   elif msg.current_position != state["prev_position"]:
     delta = msg.current_position - state["prev_position"]
     state["prev_position"] = msg.current_position
+    state["last_turned"] = time.monotonic()
     KNOB_CONNECTION[knob_id] = state
 
     if current_view:
@@ -180,49 +536,214 @@ def handle_data(knob_id, msg):
                           delta,
                           msg.current_position,
                           msg.config.min_position,
-                          msg.config.max_position
+                          msg.config.max_position,
+                          coalesce=True
                       )
 
+  # Turned part of the way towards another detent, further than
+  # sub_position_threshold. Let the action follow along in between.
+  elif state["sub_position_threshold"] is not None:
+    state["last_turned"] = time.monotonic()
+    KNOB_CONNECTION[knob_id] = state
+
+    if current_view:
+      if "knob_action" in current_view:
+        command.do_action(
+                          knob_id,
+                          current_view["knob_action"],
+                          0,
+                          msg.current_position + msg.sub_position_unit,
+                          msg.config.min_position,
+                          msg.config.max_position,
+                          coalesce=True
+                      )
+
+
+#
+# Is this view's config what the knob has ACKed,
+# with nothing newer on its way?
+#
+def config_is_applied(knob_id, template):
+  state = KNOB_CONNECTION[knob_id]
+  acked = state["acked_config"]
+
+  if acked is None:
+    return False
+
+  # Templates are serialized deterministically,
+  # so equal bytes means equal configs.
+  config_bytes, position_nonce = acked
+  return position_nonce == state["position_nonce"] and config_bytes == template.config_bytes
+
+#
+# Called from the knob's write thread when it has ACKed a config
+#
+def config_acked(queue, knob_id, config_bytes, position_nonce, nonce):
+  cmd = { "cmd": "config-acked", "knob_id": knob_id, "config": (config_bytes, position_nonce) }
+  queue.put_nowait(cmd)
+
+#
+# Send a view's knob configuration to a knob,
+# moving the knob to the given position
+#
+def send_view_config(knob_id, view, position):
+  state = KNOB_CONNECTION[knob_id]
+  handler = state["handler"]
+  template = view["template"]
+
+  # The knob only moves to the new position
+  # if position_nonce changes. The firmware keeps it in 8 bits.
+  state["position_nonce"] = (state["position_nonce"] + 1) & 0xff
+  state["sent_config"] = template.config_bytes
+
+  handler.set_config_bytes(template.config_with_position(position, state["position_nonce"]),
+    on_ack=functools.partial(config_acked,
+      command.Q_KNOB,
+      knob_id,
+      template.config_bytes,
+      state["position_nonce"])
+  )
+
+#
+# Move every knob showing a view with this knob_action
+# to the action's current value, e.g. when the system volume
+# has been changed by something other than the knob.
+# If a knob is given, only that one is moved.
+#
+def push_action_value(action_name, only_knob_id=None):
+  now = time.monotonic()
+
+  for knob_id, state in KNOB_CONNECTION.items():
+    if only_knob_id is not None and knob_id != only_knob_id:
+      continue
+
+    view = state["current_view"]
+    if view.get("knob_action", None) != action_name:
+      continue
+
+    # Don't fight the user. The value is probably
+    # lagging behind what they're doing with the knob.
+    # Have another look once they're done, though.
+    if now - state["last_turned"] < PUSH_HOLDOFF:
+      PENDING_PUSHES[(knob_id, action_name)] = state["last_turned"] + PUSH_HOLDOFF
+      continue
+
+    pos_min = view["config"].get("min_position", 0)
+    pos_max = view["config"].get("max_position", 5)
+    value = command.action_get_value(action_name, pos_min, pos_max)
+
+    # Only bother the knob if it's actually going to move
+    if value is None or value == state["prev_position"]:
+      continue
+
+    send_view_config(knob_id, view, value)
+
+#
+# Move the knob to the action's value once it has one.
+#
+def wait_for_action_value(knob_id, action_name):
+  key = (knob_id, action_name)
+  if key in VALUE_WAITS:
+    return
+
+  if command.when_action_value_available(action_name,
+      functools.partial(command.action_value_available, knob_id, action_name)):
+    VALUE_WAITS.add(key)
+
+#
+# Push the values held back during a holdoff which has ended.
+# Returns the number of seconds until the next one is due,
+# or None if there are none.
+#
+def push_pending_action_values():
+  now = time.monotonic()
+
+  for key, due in list(PENDING_PUSHES.items()):
+    if due <= now:
+      del PENDING_PUSHES[key]
+      knob_id, action_name = key
+      push_action_value(action_name, knob_id)
 
-def apply_knob_view(knob_id, new_view):
+  if not PENDING_PUSHES:
+    return None
+
+  return max(0, min(PENDING_PUSHES.values()) - now)
+
+
+def apply_knob_view(knob_id, new_view, keep_position=False):
   state = KNOB_CONNECTION.get(knob_id, None)
   if not state:
     print(f"Unable to update configuration for unknown knob {knob_id}.")
     return
 
-  handler = state["handler"]
+  # Triggers happily re-apply the view a knob is already showing.
+  # If the knob has it, or is about to, there's nothing to do.
+  template = new_view["template"]
+  if state["current_view"] == new_view and state["sent_config"] == template.config_bytes:
+    return
+
+  applied = config_is_applied(knob_id, template)
+
+  # Let the state task start fetching values for the view, if needed
+  command.view_shown(knob_id, new_view.get("knob_action", None))
 
-  # The knob's parameters
   new_knob_config = new_view["config"]
 
   initial_pos = new_knob_config.get("position", 0)
   pos_min = new_knob_config.get("min_position", 0)
   pos_max = new_knob_config.get("max_position", 5)
 
-  # If the action has a get_command specified, we'll call that
-  # to set the initial value for the view. Just you watch!
+  # If the action has a get_command specified, we'll use its value
+  # as the initial value for the view. Just you watch!
+  # If there's no value yet, the view is shown right away and
+  # the knob is moved once the value arrives.
   knob_action = new_view.get("knob_action", None)
+  if keep_position:
+    initial_pos = max(pos_min, min(state["prev_position"], pos_max))
+
   if knob_action:
-    dynamic_initial = command.action_get_value(knob_action, pos_min, pos_max, allow_delay=True)
-    if dynamic_initial: initial_pos = dynamic_initial
-
-  config = smartknob_pb2.SmartKnobConfig()
-  config.position = initial_pos
-  config.min_position = pos_min
-  config.max_position = pos_max
-  config.position_width_radians = new_knob_config.get("position_width_radians", math.radians(10))
-  config.detent_strength_unit = new_knob_config.get("detent_strength_unit", 1)
-  config.endstop_strength_unit = new_knob_config.get("endstop_strength_unit", 1)
-  config.snap_point = new_knob_config.get("snap_point", 1.1)
-  config.text = new_knob_config.get("text", "NO TEXT CONFIGURED!!")
-  config.led_hue = new_knob_config.get("led_hue", 0)
-  handler.set_config(config)
+    dynamic_initial = command.action_get_value(knob_action, pos_min, pos_max)
+    if dynamic_initial is not None:
+      initial_pos = dynamic_initial
+    else:
+      wait_for_action_value(knob_id, knob_action)
+
+  # A different view may still look the same to the knob
+  if not applied or initial_pos != state["prev_position"]:
+    send_view_config(knob_id, new_view, initial_pos)
 
   # Other settings like actions etc.
   state["current_view"] = new_view
   KNOB_CONNECTION[knob_id] = state
 
 
+#
+# Switch a knob to a view from a reloaded configuration.
+# If the knob would look the same, it's left alone.
+#
+def reload_knob_view(knob_id, new_view):
+  state = KNOB_CONNECTION[knob_id]
+
+  if not config_is_applied(knob_id, new_view["template"]):
+    # Changing a view shouldn't undo what the user has done with the knob
+    same_view = new_view["name"] == state["current_view"]["name"]
+    apply_knob_view(knob_id, new_view, keep_position=same_view)
+    return
+
+  # The actions may have changed, though
+  knob_action = new_view.get("knob_action", None)
+  action_changed = knob_action != state["current_view"].get("knob_action", None)
+
+  state["current_view"] = new_view
+
+  if action_changed:
+    command.view_shown(knob_id, knob_action)
+
+    # Show the new action's value, now or once there is one
+    if knob_action:
+      wait_for_action_value(knob_id, knob_action)
+
+
 def main(app_config):
 
   # TODO: Configurable startup config
@@ -234,51 +755,29 @@ def main(app_config):
   for c in app_config["views"]:
     knob_views[c["name"]] = c
 
-  for i in app_config["knobs"]["interfaces"]:
-    if i["kind"] == "serial":
-      portname = i.get("device", None)
+  interfaces = app_config["knobs"]["interfaces"]
 
-      portname, handler, first_status = start_serial(portname)
+  start_knob_loop()
 
-      if not handler:
-        print(f"Failed to start configured knob interface {str(i)}. Skipping.")
-        continue
-
-      KNOB_INTERFACES[portname] = handler
-
-      # TODO: Get unique ID from knob
-      knob_id = portname
-
-      if handler:
-        KNOB_CONNECTION[knob_id] = {
-            "handler": handler,
-            "prev_position": first_status.current_position,
-            "position_nonce": first_status.config.position_nonce,
-            "press_nonce": first_status.press_nonce,
-            "current_view": default_view
-          }
+  # Knobs come online as they answer
+  known_ports = start_discovery(interfaces, command.Q_KNOB)
 
-        for message_type in [ "smartknob_state" ]:
-          # Let each knob's private thread push data messages into the
-          # central handling queue
-          handler.add_handler(message_type, functools.partial(message_from_knob,
-            command.Q_KNOB,
-            knob_id,
-            message_type)
-          )
+  # Interfaces without a device or id, for whichever knobs they find
+  auto_interfaces = [ i for i in interfaces if is_auto_interface(i) ]
 
-        # Give the knob a startup configuration
-        apply_knob_view(knob_id, KNOB_CONNECTION[knob_id]["current_view"])
+  # Pick up knobs which are plugged in (or out) later on
+  if any( i["kind"] == "serial" for i in interfaces ):
+    task.hotplug.start_thread(known_ports)
 
-      else:
-        print(f"Couldn't find a knob on {portname}...")
-
-  if (verbose):
-    print(f"Started communications with {len(KNOB_CONNECTION)} knob(s).")
+  # Keep the knobs in sync with the values of their actions
+  command.subscribe_action_values(command.action_value_changed)
 
   while True:
 
-    cmd = command.Q_KNOB.get()
+    try:
+      cmd = command.Q_KNOB.get(timeout=push_pending_action_values())
+    except Empty:
+      continue
 
     if cmd is None:
       if (verbose): print("Terminating knob task.")
@@ -298,15 +797,112 @@ def main(app_config):
       # By default, apply to all knobs
       knob_ids = list(KNOB_CONNECTION.keys())
 
-      # If one is specified, apply to that one
+      # If one is specified, apply to that one.
+      # It may be a name from the configuration.
       if "knob" in cmd and cmd["knob"]:
-        knob_ids = [ cmd["knob"] ]
-        # TODO: Knob name translation
+        knob_ids = [ resolve_knob(cmd["knob"]) ]
 
       for knob_id in knob_ids:
         apply_knob_view(knob_id, new_knob_config)
 
 
+    elif cmd["cmd"] == "knob-online":
+      # A knob has answered the handshake
+      HANDSHAKING.discard(cmd["portname"])
+
+      # The same knob on two ports at once? Keep the one we have.
+      if cmd["knob_id"] in KNOB_CONNECTION:
+        print(f"Knob {cmd['knob_id']} is already connected. Ignoring it on {cmd['portname']}.")
+        retire_handler_later(cmd["handler"])
+        continue
+
+      interface = cmd["interface"]
+      auto = interface is None
+      if auto:
+        if not auto_interfaces:
+          # More knobs answered than we have interfaces for
+          retire_handler_later(cmd["handler"])
+          continue
+        interface = auto_interfaces.pop(0)
+
+      knob_id = register_knob(interface, cmd["portname"], cmd["knob_id"], cmd["handler"], cmd["first_status"], default_view, auto)
+      if (verbose):
+        name = f" ({interface['name']})" if interface.get("name", None) else ""
+        print(f"Knob {knob_id}{name} online. Talking to {len(KNOB_CONNECTION)} knob(s).")
+
+    elif cmd["cmd"] == "knob-failed":
+      HANDSHAKING.discard(cmd["portname"])
+
+    elif cmd["cmd"] == "port-added":
+      # Something was plugged in. If it's wanted, see if it's a knob.
+      port = cmd["port"]
+      portname = port.device
+      if portname in KNOB_INTERFACES or portname in HANDSHAKING:
+        continue
+
+      knob_id = stable_knob_id(port) or portname
+      if knob_id in KNOB_CONNECTION:
+        continue
+
+      wanted, interface = interface_for_port(interfaces, portname, knob_id, port.description, len(auto_interfaces) > 0)
+      if not wanted:
+        continue
+
+      if (verbose): print(f"Serial port {portname} appeared.")
+      start_handshake(command.Q_KNOB, handshake_serial, interface, portname, knob_id)
+
+    elif cmd["cmd"] == "port-removed":
+      # Something was unplugged. If it was a knob, let it go.
+      knob_id = KNOB_INTERFACES.pop(cmd["portname"], None)
+      if knob_id is None:
+        continue
+
+      print(f"Knob {knob_id} was disconnected.")
+      state = KNOB_CONNECTION.pop(knob_id)
+      retire_handler_later(state["handler"])
+
+      name = state["interface"].get("name", None)
+      if name and KNOB_NAMES.get(name, None) == knob_id:
+        del KNOB_NAMES[name]
+
+      # Its view is no longer shown anywhere
+      command.view_shown(knob_id, None)
+
+      # Someone else may use the interface now
+      if state["auto"]:
+        auto_interfaces.append(state["interface"])
+
+    elif cmd["cmd"] == "config":
+      # The configuration has been reloaded.
+      # Knobs stay connected, and keep showing the same view if it's still there.
+      new_config = cmd["config"]
+      verbose = new_config["nobbler"].get("verbose", False)
+
+      if new_config["knobs"] != app_config["knobs"]:
+        print("Changes to knob interfaces take effect when nobbler is restarted.")
+
+      default_view = new_config["views"][0]
+      knob_views = {}
+      for c in new_config["views"]:
+        knob_views[c["name"]] = c
+
+      for knob_id, state in KNOB_CONNECTION.items():
+        reload_knob_view(knob_id, knob_views.get(state["current_view"]["name"], default_view))
+
+      app_config = new_config
+
+    elif cmd["cmd"] == "config-acked":
+      # A knob has confirmed that it got a config
+      if cmd["knob_id"] in KNOB_CONNECTION:
+        KNOB_CONNECTION[cmd["knob_id"]]["acked_config"] = cmd["config"]
+
+    elif cmd["cmd"] == "action-value":
+      # A value we've been waiting for has arrived,
+      # or the value of some action has changed
+      if cmd["knob_id"] is not None:
+        VALUE_WAITS.discard((cmd["knob_id"], cmd["action"]))
+      push_action_value(cmd["action"], cmd["knob_id"])
+
     elif cmd["cmd"] == "data":
       # Data has arrived from a knob
       #print(f"Message[{cmd['knob_id']}] ({cmd['message_type']}): {cmd['message']}")
@@ -319,8 +915,19 @@ def main(app_config):
         continue
 
 
+  task.hotplug.stop_thread()
+  stop_discovery(command.Q_KNOB)
+
   for name, state in KNOB_CONNECTION.items():
     try:
       state["handler"].shutdown()
     except:
       pass
+
+  for t in RETIRE_THREADS:
+    t.join()
+
+  for simulator in SIMULATED_KNOBS:
+    simulator.stop()
+
+  stop_knob_loop()
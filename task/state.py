@@ -3,10 +3,11 @@
 # things we want to display on the knob
 #
 # Each "get_command" specified by a configured action
-# will get its own multiprocessing.process to run that
-# command continuously (or periodically) and feed the
-# output back to the main task. There, the value is
-# stored.
+# is run continuously (or periodically) by a single
+# supervisor, an asyncio event loop in its own thread.
+# It owns all the commands' processes directly, reads
+# their output without blocking and feeds the values back
+# to the main task. There, the value is stored.
 #
 # When we need a value (e.g. when a knob changes view)
 # we can look the data up in a quick table rather than
@@ -19,13 +20,12 @@
 # as output. That way, if you don't want polling you can create
 # a get_command which is event-driven.
 
-import time
+import asyncio
+import functools
+import random
 import subprocess
-import multiprocessing
 import threading
 import re
-import io
-import os
 import psutil
 
 import command
@@ -33,8 +33,80 @@ from task.action import NOBBLER_SCRIPTS_DIR
 
 _ALL_ACTIONS = {}
 
-_RAW_VALUES_LOCK = threading.Lock()
-_RAW_VALUES = {}
+# From the "nobbler" configuration
+_VERBOSE = False
+
+#
+# The most recent raw value from each action's get_command.
+# Readers can block until a value arrives, have a callback
+# run as soon as it does, or subscribe to be told whenever
+# it changes after that. Nobody needs to poll.
+#
+class _ValueStore(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._conditions = {}
+        self._callbacks = {}
+        self._subscribers = []
+
+    def _condition(self, key):
+        if key not in self._conditions:
+            self._conditions[key] = threading.Condition(self._lock)
+        return self._conditions[key]
+
+    def get(self, key):
+        with self._lock:
+            return self._values.get(key, None)
+
+    def set(self, key, value):
+        with self._lock:
+            # Nobody needs to hear about a value they already have
+            if self._values.get(key, None) == value:
+                return
+
+            first = key not in self._values
+            self._values[key] = value
+            self._condition(key).notify_all()
+
+            # The first value goes to whoever is waiting for it,
+            # later ones to the subscribers
+            if first:
+                callbacks = self._callbacks.pop(key, [])
+            else:
+                callbacks = [ functools.partial(s, key) for s in self._subscribers ]
+
+        for callback in callbacks:
+            callback()
+
+    def wait(self, key, timeout=None):
+        with self._lock:
+            self._condition(key).wait_for(lambda: key in self._values, timeout)
+            return self._values.get(key, None)
+
+    # Forget a value which can't be trusted anymore.
+    # The next one to arrive is a first value again.
+    def clear(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    # Runs callback() once, as soon as there is a value.
+    # If there already is one, that's right now.
+    def when_available(self, key, callback):
+        with self._lock:
+            if key not in self._values:
+                self._callbacks.setdefault(key, []).append(callback)
+                return
+
+        callback()
+
+    # Runs callback(key) each time a value changes.
+    # The first value of each key goes to when_available() instead.
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+_VALUES = _ValueStore()
 
 def _clamp(value, d_min, d_max):
   value = max(value, d_min)
@@ -65,105 +137,277 @@ def _get_value_from_output(output):
 
 
 
+def _kill_tree(pid):
+    # get_commands run in a shell, so the command itself
+    # is probably a child of the process we started
+    try:
+        parent = psutil.Process(pid)
+        children = parent.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return
+
+    # The shell goes first, so it doesn't complain about its children
+    for p in [ parent ] + children:
+        try:
+            p.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+
 #
-# Body of a multiprocessing.process which runs a command,
-# reads continuous output and feeds the result back
+# Sends values for an action back to the main task,
+# at most max_rate times per second. Values arriving
+# faster than that replace each other, and the most
+# recent one is sent as soon as it's allowed.
 #
-def _proc_action_cmd_persistent(cmdline, action_name, data_queue, quit_queue):
-    cmdline = cmdline.replace("{scripts}", NOBBLER_SCRIPTS_DIR)
+class _ValueForwarder(object):
+    def __init__(self, action_name, max_rate, loop):
+        self._action_name = action_name
+        self._loop = loop
+        self.set_max_rate(max_rate)
+        self._latest = None
+        self._last_sent = None
+        self._flush_handle = None
+
+    def _flush(self):
+        self._flush_handle = None
+        if self._latest is None:
+            return
+
+        command.Q_STATE.put({
+            "cmd": "value",
+            "action": self._action_name,
+            "value": self._latest
+        })
+        self._latest = None
+        self._last_sent = self._loop.time()
+
+    def set_max_rate(self, max_rate):
+        self._min_interval = 1.0 / max_rate if max_rate else 0
+
+    def offer(self, value):
+        self._latest = value
+
+        if self._flush_handle is not None:
+            return
+
+        wait = 0
+        if self._last_sent is not None:
+            wait = self._last_sent + self._min_interval - self._loop.time()
+
+        if wait <= 0:
+            self._flush()
+        else:
+            self._flush_handle = self._loop.call_later(wait, self._flush)
+
+    def cancel(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
 
-    while True:
-        
-        # Run the command and take all the output we can from it
-        # If it exits (that's fine), we'll just treat it as a polling
-        # command and try again after a short delay.
-
-        #print(f"Invoking system command {cmdline}")
-        child = subprocess.Popen(cmdline, shell=True, stdout=subprocess.PIPE, text=True, universal_newlines=True, bufsize=-1)
-
-        while True:
-
-            # Wait for more output
-            # I'd love to use select.select() here, but I can't get it
-            # to work with a pipe on Windows. Too bad.
-            #print("Checking for output...")
-            output_line = child.stdout.readline()
-
-            #print("Output: ", output_line)
-            
-            # TODO: Read as many as we can without blocking
-            # If we've received multiple lines of output
-            # with data, we will just skip forward to the
-            # most recent valid one.
-
-            value = _get_value_from_output(output_line)
-
-            if value:
-                data_queue.put({
-                    "cmd": "value",
-                    "action": action_name,
-                    "value": value
-                })
-
-
-            try:
-                _ = quit_queue.get(block=False)
-                child.terminate()
-                return
-            except:
-                # No command to exit just yet
-                pass
-
-            # If the process has terminated, stop reading
-            if child.poll() is not None:
-                break
 
+#
+# Finds the most recent valid value among some complete lines of output
+#
+def _get_latest_value(lines):
+    for line in reversed(lines):
+        line = line.strip()
+        if not line:
+            continue
 
-        # TODO: Configurable polling delay
-        #print("Process terminated. Starting over.")
-        child.terminate()
-        time.sleep(1.0)
+        value = _get_value_from_output(line)
+        if value is not None:
+            return value
 
-        
+    return None
 
 
 #
-# Body of a multiprocessing.process which continously
-# runs a command and feeds the result back
+# Runs every get_command, from a single asyncio event loop.
 #
-def _proc_action_cmd_poll(cmdline, action_name, queue):
-    cmdline = cmdline.replace("{scripts}", NOBBLER_SCRIPTS_DIR)
-    while True:
+# A command which exits is run again after its action's get_interval,
+# give or take get_jitter (a fraction of the interval) so that commands
+# don't all run in lockstep. A command which fails (exits with an error
+# or without printing a value) is retried with exponential backoff,
+# up to get_backoff_max seconds.
+#
+# Actions with get_when "active" only run their command while a view
+# using the action is shown on some knob.
+#
+# All methods must be called from the loop's thread.
+#
+class _Supervisor(object):
+    def __init__(self, loop):
+        self._loop = loop
+        self._actions = {}
+        self._tasks = {}
+        self._forwarders = {}
+        self._failures = {}
+        self._active = set()
+
+    def _should_run(self, action_name):
+        action = self._actions[action_name]
+        return action.get("get_when", "always") == "always" or action_name in self._active
+
+    def _update(self):
+        for action_name in self._actions:
+            running = action_name in self._tasks
+            should_run = self._should_run(action_name)
+
+            if should_run and not running:
+                self._tasks[action_name] = self._loop.create_task(self._supervise_command(action_name))
+            elif running and not should_run:
+                self._tasks.pop(action_name).cancel()
+                self._forget(action_name)
+
+    #
+    # Nothing keeps the value of a stopped command up to date,
+    # so it shouldn't be shown on any knob.
+    #
+    def _forget(self, action_name):
+        # Values it has already sent are queued before this,
+        # and this makes sure no more are sent after it
+        forwarder = self._forwarders.pop(action_name, None)
+        if forwarder is not None:
+            forwarder.cancel()
+
+        command.Q_STATE.put({
+            "cmd": "forget",
+            "action": action_name
+        })
+
+    #
+    # Takes a new set of actions. May be called again on a running supervisor,
+    # and only the commands whose command line has changed are restarted.
+    # Other settings take effect the next time they're needed.
+    #
+    def configure(self, actions):
+        old_actions = self._actions
+
+        self._actions = {}
+        for action_name, action in actions.items():
+            if action.get("get_command", None):
+                self._actions[action_name] = action
+
+        for action_name in list(self._tasks.keys()):
+            action = self._actions.get(action_name, None)
+            if action is None:
+                self._tasks.pop(action_name).cancel()
+                self._failures.pop(action_name, None)
+                self._forget(action_name)
+            elif action["get_command"] != old_actions[action_name]["get_command"]:
+                # The new command's first value replaces the old one
+                self._tasks.pop(action_name).cancel()
+                self._failures.pop(action_name, None)
+            elif action_name in self._forwarders:
+                self._forwarders[action_name].set_max_rate(action.get("get_max_rate", None))
+
+        self._update()
+
+    def set_active(self, action_names):
+        self._active = set(action_names)
+        self._update()
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        self._tasks = {}
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _next_delay(self, action_name, success):
+        action = self._actions[action_name]
+        interval = action.get("get_interval", 1.0)
+
+        if success:
+            self._failures[action_name] = 0
+            delay = interval
+        else:
+            failures = self._failures.get(action_name, 0) + 1
+            self._failures[action_name] = failures
+            delay = min(max(interval, 0.1) * 2 ** failures, action.get("get_backoff_max", 60.0))
+            print(f"get_command for {action_name} failed. Retrying in {delay:.1f} s.")
+
+        jitter = action.get("get_jitter", 0.1)
+        return delay * random.uniform(1 - jitter, 1 + jitter)
+
+    #
+    # Runs a command, reads continuous output and feeds the result back.
+    # If the command exits, it's started over.
+    #
+    async def _supervise_command(self, action_name):
+        action = self._actions[action_name]
+        cmdline = action["get_command"].replace("{scripts}", NOBBLER_SCRIPTS_DIR)
+        forwarder = _ValueForwarder(action_name, action.get("get_max_rate", None), self._loop)
+        self._forwarders[action_name] = forwarder
 
         try:
-            # TODO: Continuously read data from command output
-            output = subprocess.check_output(cmdline, timeout=1, shell=True)
+            while True:
 
-            if not output:
-                raise Warning("No value")
+                # Run the command and take all the output we can from it
+                # If it exits (that's fine), we'll just treat it as a polling
+                # command and try again after a short delay.
 
-            value = _get_value_from_output(output.decode())
+                #print(f"Invoking system command {cmdline}")
+                child = await asyncio.create_subprocess_shell(cmdline, stdout=subprocess.PIPE)
+                got_value = False
 
-            if not value:
-                raise Warning("No value")
+                try:
+                    partial = b''
+                    while True:
+                        # Take everything the command has written so far.
+                        # If it has printed lots of lines, only the
+                        # most recent value is of any interest.
+                        output = await child.stdout.read(65536)
 
-            # Send the value back to the mother thread
-            queue.put({
-                "cmd": "value",
-                "action": action_name,
-                "value": value
-            })
+                        # The process has closed its output, stop reading
+                        if not output:
+                            break
 
-        
-        except subprocess.CalledProcessError as e:
-            print(f"Command {cmdline} failed to execute:")
-            print(output)
+                        lines = (partial + output).split(b'\n')
+                        partial = lines.pop()
 
-        except:
-            pass
-        
-        # TODO: Configurable polling rate
-        time.sleep(1)
+                        value = _get_latest_value([ l.decode(errors="replace") for l in lines ])
+                        if value is not None:
+                            forwarder.offer(value)
+                            got_value = True
+
+                    # Output without a final newline
+                    value = _get_latest_value([ partial.decode(errors="replace") ])
+                    if value is not None:
+                        forwarder.offer(value)
+                        got_value = True
+
+                    returncode = await child.wait()
+
+                except asyncio.CancelledError:
+                    _kill_tree(child.pid)
+                    await child.wait()
+                    raise
+
+                #print("Process terminated. Starting over.")
+                await asyncio.sleep(self._next_delay(action_name, got_value and returncode == 0))
+        finally:
+            forwarder.cancel()
+            if self._forwarders.get(action_name, None) is forwarder:
+                del self._forwarders[action_name]
+
+
+#
+# Body of the supervisor thread.
+# Runs the supervisor's loop until stop_event is set.
+#
+def _supervisor_main(loop, supervisor, actions, stop_event):
+    asyncio.set_event_loop(loop)
+
+    async def _supervise_all():
+        supervisor.configure(actions)
+        await stop_event.wait()
+        await supervisor.stop()
+
+    try:
+        loop.run_until_complete(_supervise_all())
+    finally:
+        loop.close()
 
 
 def get_value_for_action(action_name, range_min, range_max, allow_delay=False):
@@ -174,28 +418,14 @@ def get_value_for_action(action_name, range_min, range_max, allow_delay=False):
     if not action:
         return None
 
-    # Boot-up hack
     # If we still haven't gotten any values after starting up,
-    # just delay this command a bit. It'll be OK.
-    if allow_delay:
-        for wait_tick in range(10):
-            need_wait = False
-            with _RAW_VALUES_LOCK:
-                if ("get_command" in action and action_name not in _RAW_VALUES):
-                    need_wait = True
-
-            if need_wait:
-                print(f"No known value for {action_name} yet. Delaying.")
-                time.sleep(0.1)
-            else:
-                break
-
-
-    # The raw value received from the background process
-    with _RAW_VALUES_LOCK:
-        raw_value = _RAW_VALUES.get(action_name, None)
+    # wait a bit for the first one.
+    if allow_delay and "get_command" in action:
+        raw_value = _VALUES.wait(action_name, timeout=1.0)
+    else:
+        raw_value = _VALUES.get(action_name)
 
-    if not raw_value:
+    if raw_value is None:
         return None          
 
 
@@ -210,35 +440,47 @@ def get_value_for_action(action_name, range_min, range_max, allow_delay=False):
     else:
         clean_value = _clamp(raw_value, range_min, range_max)
 
-    print(f"Found value for {action_name}: {clean_value}")
+    if _VERBOSE: print(f"Found value for {action_name}: {clean_value}")
 
     return clean_value
 
-def _kill_children(proc):
-    if not proc.pid: return
+#
+# Run callback() as soon as the action's get_command
+# has produced a value. Right away, if it already has.
+# Actions without a get_command never get a value,
+# in which case False is returned.
+#
+def when_value_available(action_name, callback):
+    action = _ALL_ACTIONS.get(action_name, None)
+    if not action or "get_command" not in action:
+        return False
 
-    parent = psutil.Process(proc.pid)
-    for child in parent.children(recursive=True):
-        child.kill()
+    _VALUES.when_available(action_name, callback)
+    return True
 
+#
+# Run callback(action_name) every time the value of
+# an action's get_command changes, from the state task's thread.
+# Only changes of a value which has been available are included.
+#
+def subscribe_value_changes(callback):
+    _VALUES.subscribe(callback)
 
 def main(app_config):
-
-    processes = []
+    global _VERBOSE
+    _VERBOSE = app_config["nobbler"].get("verbose", False)
 
     for a in app_config["actions"]:
         _ALL_ACTIONS[a["name"]] = a
 
+    # Which action each knob's current view uses
+    knob_actions = {}
 
-    for action_name, action in _ALL_ACTIONS.items():
-        cmdline = action.get("get_command", None)
-
-        if not cmdline: continue
-
-        quit_queue = multiprocessing.Queue()
-        process = multiprocessing.Process(target=_proc_action_cmd_persistent, args=(cmdline, action_name, command.Q_STATE, quit_queue))
-        process.start()
-        processes.append((process, quit_queue))
+    loop = asyncio.new_event_loop()
+    stop_event = asyncio.Event()
+    supervisor = _Supervisor(loop)
+    supervisor_thread = threading.Thread(target=_supervisor_main, args=(loop, supervisor, dict(_ALL_ACTIONS), stop_event))
+    supervisor_thread.start()
 
 
     while True:
@@ -252,12 +494,27 @@ def main(app_config):
 
         # We've received an updated value from a background process
         if cmd["cmd"] == "value":
-            with _RAW_VALUES_LOCK:
-                _RAW_VALUES[cmd["action"]] = cmd["value"]
+            _VALUES.set(cmd["action"], cmd["value"])
+
+        # A get_command has been stopped, its value is stale
+        elif cmd["cmd"] == "forget":
+            _VALUES.clear(cmd["action"])
+
+        # The configuration has been reloaded
+        elif cmd["cmd"] == "config":
+            _VERBOSE = cmd["config"]["nobbler"].get("verbose", False)
+            _ALL_ACTIONS.clear()
+            for a in cmd["config"]["actions"]:
+                _ALL_ACTIONS[a["name"]] = a
+            loop.call_soon_threadsafe(supervisor.configure, dict(_ALL_ACTIONS))
+
+        # A knob has switched to a different view
+        elif cmd["cmd"] == "view-shown":
+            knob_actions[cmd["knob_id"]] = cmd["action"]
+            active = set(a for a in knob_actions.values() if a)
+            loop.call_soon_threadsafe(supervisor.set_active, active)
 
 
 
-    for proc,quit_queue in processes:
-        quit_queue.put(True)
-        _kill_children(proc)
-        proc.join()
+    loop.call_soon_threadsafe(stop_event.set)
+    supervisor_thread.join()
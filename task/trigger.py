@@ -1,7 +1,16 @@
-
 import command
 import triggers.activewindow
 
+#
+# The settings which decide how the focused window is tracked
+#
+def _focus_settings(window_triggers):
+  if not window_triggers:
+    return None
+
+  t = window_triggers[0]
+  return (t.get("backend", "auto"), t.get("poll_interval", 0.2), t.get("settle_time", 0.1))
+
 def main(app_config):
 
 
@@ -12,8 +21,16 @@ def main(app_config):
 
   # Only start this thread if the user has configured any window-related
   # triggers. Otherwise it will do a bunch of polling for no reason.
+  # There's only one focused window, so the first trigger
+  # decides how it's tracked.
   if len(window_triggers) > 0:
-    triggers.activewindow.start_thread(app_config)
+    triggers.activewindow.start_thread(app_config, window_triggers[0])
+
+  matcher = triggers.activewindow.WindowMatcher(window_triggers)
+
+  # The most recent window-focused command, to re-run
+  # against the mappings when they change
+  last_focused = None
 
 
   while True:
@@ -23,34 +40,31 @@ def main(app_config):
     if cmd is None:
       break
 
-    if cmd["cmd"] == "window-focused":
+    if cmd["cmd"] == "config":
+      new_window_triggers = list(filter(lambda t: t["kind"] == "active-window", cmd["config"]["triggers"]))
 
-      window_info = cmd
-      for t in window_triggers:
+      # Only restart window tracking if it needs to change
+      if _focus_settings(new_window_triggers) != _focus_settings(window_triggers):
+        triggers.activewindow.stop_thread()
+        last_focused = None
+        if len(new_window_triggers) > 0:
+          triggers.activewindow.start_thread(cmd["config"], new_window_triggers[0])
 
-        for m in t.get("mappings", []):
-          #
-          # The first mapping that matches our focused window gets applied.
-          # If a mapping has no filters, it's a default and will match for sure.
+      window_triggers = new_window_triggers
+      matcher = triggers.activewindow.WindowMatcher(window_triggers)
 
-          filters = m.get("filters", [])
+      if last_focused:
+        cmd = last_focused
 
-          matches = True
-
-          for f in filters:
-            if not triggers.activewindow.matches(f, window_info):
-              matches = False
-              break
-
-          if matches:
-            # This mapping matches the window.
-            # Apply all the views it asks for.
-
-            for v in m.get("views", []):
-              if "view" not in v: continue
-              command.set_view(v["view"], v.get("knob", None))
-
-            break
+    if cmd["cmd"] == "window-focused":
+      last_focused = cmd
+
+      #
+      # The first mapping of each trigger that matches
+      # our focused window gets applied.
+      # If a mapping has no filters, it's a default and will match for sure.
+      for view, knob in matcher.match(cmd["title"], cmd["appname"]):
+        command.set_view(view, knob)
 
   print("Terminating trigger task.")
   triggers.activewindow.stop_thread()
@@ -1,22 +1,274 @@
+import abc
+import functools
+import os
+import select
+import sys
 import threading
 import time
 import re
 
 import pywinctl
 
+# Only needed for the X11 focus source
+try:
+    import Xlib.display
+    import Xlib.error
+    import Xlib.X
+except ImportError:
+    Xlib = None
+
 import command
 
 THREAD = None
 THREAD_RUNNING = False
-WINDOW_POLLING_DELAY = 0.2
+
+# How often the thread checks whether it's been asked to stop,
+# if the focus source has nothing to say
+STOP_CHECK_DELAY = 0.5
+
+
+#
+# Something which knows which window has focus.
+#
+# get_focused() returns (title, appname) of the focused window,
+# or None if no window is focused.
+# wait(timeout) blocks until focus may have changed, or the timeout passes.
+#
+class FocusSource(abc.ABC):
+    @abc.abstractmethod
+    def get_focused(self):
+        pass
+
+    @abc.abstractmethod
+    def wait(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
+
+#
+# Asks pywinctl every poll_interval seconds.
+# Works everywhere, but focus changes are noticed late.
+#
+class PollingFocusSource(FocusSource):
+    def __init__(self, poll_interval):
+        self.poll_interval = poll_interval
+
+    def get_focused(self):
+        window = pywinctl.getActiveWindow()
+        if window is None:
+            return None
+
+        # On windows, getAppName() fails for some reason. Too bad.
+        appname = ""
+        try:
+            appname = window.getAppName()
+        except:
+            pass
+
+        return (window.title, appname)
+
+    def wait(self, timeout):
+        time.sleep(min(self.poll_interval, timeout))
+
+
+#
+# Listens for PropertyNotify on the root window's _NET_ACTIVE_WINDOW,
+# and on the focused window's name, so nothing is polled.
+# Needs python-xlib and an EWMH compliant window manager.
+#
+class X11FocusSource(FocusSource):
+    def __init__(self):
+        if Xlib is None:
+            raise RuntimeError("The x11 backend needs python-xlib")
+
+        self._display = Xlib.display.Display()
+        self._root = self._display.screen().root
+
+        self._NET_ACTIVE_WINDOW = self._display.intern_atom("_NET_ACTIVE_WINDOW")
+        self._NET_WM_NAME = self._display.intern_atom("_NET_WM_NAME")
+        self._NET_WM_PID = self._display.intern_atom("_NET_WM_PID")
+        self._UTF8_STRING = self._display.intern_atom("UTF8_STRING")
+        self._WM_NAME = self._display.intern_atom("WM_NAME")
+
+        self._watched = None
+
+        self._root.change_attributes(event_mask=Xlib.X.PropertyChangeMask)
+        self._display.flush()
+
+    def _property(self, window, atom, prop_type):
+        prop = window.get_full_property(atom, prop_type)
+        if prop is None:
+            return None
+        return prop.value
+
+    def _active_window(self):
+        value = self._property(self._root, self._NET_ACTIVE_WINDOW, Xlib.X.AnyPropertyType)
+        if not value or value[0] == Xlib.X.NONE:
+            return None
+        return self._display.create_resource_object("window", value[0])
+
+    def _title(self, window):
+        title = self._property(window, self._NET_WM_NAME, self._UTF8_STRING)
+        if title is None:
+            title = self._property(window, self._WM_NAME, Xlib.X.AnyPropertyType)
+        if title is None:
+            return ""
+        if isinstance(title, bytes):
+            return title.decode("utf-8", "replace")
+        return title
+
+    def _appname(self, window):
+        # Same as pywinctl: the name of the window's process
+        pid = self._property(window, self._NET_WM_PID, Xlib.X.AnyPropertyType)
+        if pid:
+            try:
+                with open(f"/proc/{pid[0]}/comm") as f:
+                    return f.read().strip()
+            except OSError:
+                pass
+
+        wm_class = window.get_wm_class()
+        if wm_class:
+            return wm_class[1]
+        return ""
+
+    def _watch(self, window):
+        # Title changes of the focused window count as focus changes too
+        if self._watched is not None and window is not None and self._watched.id == window.id:
+            return
+
+        if self._watched is not None:
+            try:
+                self._watched.change_attributes(event_mask=Xlib.X.NoEventMask)
+            except Xlib.error.XError:
+                pass
+
+        self._watched = window
+        if window is not None:
+            window.change_attributes(event_mask=Xlib.X.PropertyChangeMask)
+        self._display.flush()
+
+    def get_focused(self):
+        try:
+            window = self._active_window()
+            self._watch(window)
+            if window is None:
+                return None
+            return (self._title(window), self._appname(window))
+        except Xlib.error.XError:
+            # The window went away while we were looking at it.
+            # There'll be another event for whatever comes next.
+            self._watched = None
+            return None
+
+    def wait(self, timeout):
+        if not self._display.pending_events():
+            readable, _, _ = select.select([self._display.fileno()], [], [], timeout)
+            if not readable:
+                return
+
+        # Each wakeup is worth one get_focused(), however many events there were
+        while self._display.pending_events():
+            self._display.next_event()
+
+    def close(self):
+        self._display.close()
+
+
+#
+# The focus source asked for in a trigger's configuration.
+# "auto" prefers events over polling, where possible.
+#
+def make_focus_source(backend, poll_interval, verbose=False):
+    if backend in [ "auto", "x11" ]:
+        usable = Xlib is not None and sys.platform.startswith("linux") and os.environ.get("DISPLAY")
+        if usable or backend == "x11":
+            try:
+                source = X11FocusSource()
+                if verbose: print("Tracking the active window with X11 events.")
+                return source
+            except Exception as e:
+                print(f"Unable to use X11 for the active window, falling back to polling: {e}")
+
+    if verbose: print(f"Polling for the active window every {poll_interval} s.")
+    return PollingFocusSource(poll_interval)
+
+
+#
+# Decides when focus has actually changed.
+#
+# Focus is a (title, appname) tuple, ("", "") meaning no window.
+# A new focus has to hold for settle_time seconds before
+# it's reported, so windows which are only passed over
+# (alt-tab, a dialog flashing by) never reach the triggers.
+#
+#   SETTLED  focus is what was last reported
+#   PENDING  focus differs, and has since `since`
+#
+# Going back to the reported focus while PENDING cancels the change.
+#
+class FocusTracker(object):
+    SETTLED = "settled"
+    PENDING = "pending"
+
+    NO_FOCUS = ("", "")
+
+    def __init__(self, settle_time):
+        self.settle_time = settle_time
+        self.state = self.SETTLED
+        self.reported = None
+        self.candidate = None
+        self.since = None
+
+    #
+    # Feed the current focus. Returns the focus to report,
+    # or None if there's nothing to report yet.
+    #
+    def update(self, focused, now):
+        if focused is None:
+            focused = self.NO_FOCUS
+
+        # The very first focus has nothing to settle against
+        if self.reported is None:
+            self.reported = focused
+            return focused
+
+        if focused == self.reported:
+            self.state = self.SETTLED
+            self.candidate = None
+            return None
+
+        if self.state == self.SETTLED or focused != self.candidate:
+            self.state = self.PENDING
+            self.candidate = focused
+            self.since = now
+
+        if now - self.since >= self.settle_time:
+            self.state = self.SETTLED
+            self.reported = self.candidate
+            self.candidate = None
+            return self.reported
+
+        return None
+
+    #
+    # Seconds until a pending focus would settle, if nothing changes
+    #
+    def time_to_settle(self, now):
+        if self.state != self.PENDING:
+            return None
+        return max(0, self.since + self.settle_time - now)
+
 
 #
 # Start a thread which keeps track of the current active window
 # and sends events when it changes
 #
-def start_thread(app_config):
+def start_thread(app_config, trigger_config):
     global THREAD
-    THREAD = threading.Thread(target=thread_main, args=(app_config,))
+    THREAD = threading.Thread(target=thread_main, args=(app_config, trigger_config))
     THREAD.start()
 
     return THREAD
@@ -31,56 +283,131 @@ def stop_thread():
         THREAD = None
 
 
-def thread_main(app_config):
+def thread_main(app_config, trigger_config):
     global THREAD_RUNNING
     THREAD_RUNNING = True
 
     verbose = app_config["nobbler"].get("verbose", False)
 
-    last_window = None
+    source = make_focus_source(trigger_config.get("backend", "auto"),
+                               trigger_config.get("poll_interval", 0.2),
+                               verbose)
+    tracker = FocusTracker(trigger_config.get("settle_time", 0.1))
 
-    # This is a polling loop.
-    # There is no portable way to get
-    # this in an event driven manner, as far as I know.
     while THREAD_RUNNING:
-        window = pywinctl.getActiveWindow()
+        now = time.monotonic()
+        focused = tracker.update(source.get_focused(), now)
 
-        if window is None:
-            if verbose: print(f"No window focused.")
-            command.window_focused("", "")
+        if focused is not None:
+            title, appname = focused
+            if verbose:
+                if focused == FocusTracker.NO_FOCUS:
+                    print(f"No window focused.")
+                else:
+                    print(f"Window focused: appname=\"{appname}\"    title=\"{title}\"")
+            command.window_focused(title, appname)
 
-        if window != last_window:
+        # Come back when a pending change would have settled,
+        # even if the focus source has nothing new to say.
+        timeout = STOP_CHECK_DELAY
+        settle = tracker.time_to_settle(now)
+        if settle is not None:
+            timeout = min(timeout, settle)
 
-            # On windows, getAppName() fails for some reason. Too bad.
-            appname = ""
-            try:
-                appname = window.getAppName()
-            except:
-                pass
+        source.wait(timeout)
+
+    source.close()
+
+
+#
+# The active-window triggers, compiled once.
+#
+# Each trigger applies its first matching mapping, so for every
+# trigger the matcher has to find the lowest numbered mapping
+# which matches the window. Most mappings are a single
+# plain regex, and those are folded into one big alternation
+# per property. Python tries alternatives left to right, so
+# the one which matches is the lowest numbered one.
+# Anything else (several filters, regexes with groups or flags,
+# defaults without filters) is checked one by one, but only
+# the ones which come before the alternation's answer.
+#
+class WindowMatcher(object):
+    CACHE_SIZE = 1024
+
+    def __init__(self, window_triggers):
+        self._triggers = [ self._compile_trigger(t) for t in window_triggers ]
+
+        # Windows tend to get focused again and again
+        self.match = functools.lru_cache(maxsize=self.CACHE_SIZE)(self._match)
+
+    def _compile_filter(self, filter):
+        prop = filter.get("property", "title")
+        pattern = filter.get("pattern", ".*")
+
+        if prop not in [ "title", "appname" ]:
+            print(f"Trying to filter a trigger unknown window property {prop}. Check your configuration.")
+            return prop, None
+
+        try:
+            return prop, re.compile(pattern)
+        except re.error:
+            print(f"Invalid regular expression \"{pattern}\" in window filter. Check your configuration.")
+            return prop, None
+
+    def _compile_trigger(self, trigger):
+        # Alternatives for each property, as (mapping index, pattern)
+        simple = { "title": [], "appname": [] }
+
+        # (mapping index, [ (property, compiled regex) ])
+        ordered = []
+
+        views = []
+
+        for index, mapping in enumerate(trigger.get("mappings", [])):
+            views.append(tuple( (v["view"], v.get("knob", None))
+                                for v in mapping.get("views", []) if "view" in v ))
+
+            filters = [ self._compile_filter(f) for f in mapping.get("filters", []) ]
+
+            if len(filters) == 1:
+                prop, regex = filters[0]
+                if regex is not None and regex.groups == 0 and regex.flags == re.UNICODE:
+                    simple[prop].append((index, regex.pattern))
+                    continue
+
+            ordered.append((index, filters))
+
+        combined = {}
+        for prop, alternatives in simple.items():
+            if not alternatives: continue
+            combined[prop] = re.compile("|".join(f"(?P<m{index}>{pattern})"
+                                                 for index, pattern in alternatives))
+
+        return combined, ordered, views
+
+    def _match(self, title, appname):
+        window_info = { "title": title, "appname": appname }
+        result = []
+
+        for combined, ordered, views in self._triggers:
+            best = len(views)
+
+            for prop, regex in combined.items():
+                m = regex.match(window_info[prop])
+                if m:
+                    best = min(best, int(m.lastgroup[1:]))
+
+            for index, filters in ordered:
+                if index >= best:
+                    break
+
+                if all(regex is not None and regex.match(window_info[prop])
+                       for prop, regex in filters):
+                    best = index
+                    break
+
+            if best < len(views):
+                result += views[best]
 
-            if verbose: print(f"Window focused: appname=\"{appname}\"    title=\"{window.title}\"")
-            command.window_focused(window.title, appname)
-            
-        last_window = window
-        time.sleep(WINDOW_POLLING_DELAY)        
-
-
-def matches(filter, window_info):
-    prop = filter.get("property", "title")
-    value = window_info.get(prop, None)
-
-    if value is None:
-        print("Trying to filter a trigger unknown window property {prop}. Check your configuration.")
-        return False
-    
-    pattern = filter.get("pattern", ".*")
-
-    try:
-        res = re.match(pattern, value)
-    except:
-        print(f"Invalid regular expression \"{pattern}\" in window filter. Check your configuration.")
-        return False
-    
-    if res:
-        return True
-    return False
\ No newline at end of file
+        return tuple(result)